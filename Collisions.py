@@ -0,0 +1,217 @@
+from math import floor
+import numpy as np
+from numba import njit
+from RayCasting import in_view_grid
+
+
+@njit(cache=True)
+def cell_index(value, tile, count):
+    # Номер клетки для координаты value, ограниченный картой из count клеток
+    return min(max(value // tile, 0), count - 1)
+
+
+@njit(cache=True)
+def overlap_edge(boxes, j, edge, x, y, size, step, axis):
+    # Граница врага j для blocking_edge, если его рект пересекается с ректом (x, y, size, size)
+    other_x, other_y = boxes[j, 0], boxes[j, 1]
+    if (x < other_x + size and other_x < x + size and
+            y < other_y + size and other_y < y + size):
+        start = other_x if axis == 0 else other_y
+        near = start + size if step < 0 else start
+        if edge == -1 or (step < 0 and near > edge) or (step > 0 and near < edge):
+            edge = near
+    return edge
+
+
+@njit(cache=True)
+def blocking_edge(boxes, keys, owners, slack, jumped, jumps, i, x, y, size, step, axis,
+                  grid, tile_w, tile_h):
+    # Ближайшая к врагу i граница стены или другого врага, с которой пересекается его рект
+    # (x, y, size, size) при движении на step по оси axis (0 - x, 1 - y). Возвращает -1, если
+    # пересечений нет. Враги ищутся в корзинах keys, owners из bucket_boxes в клетках рядом
+    # с ректом с запасом slack на перемещение за шаг и среди jumps врагов из jumped, которые
+    # за шаг сдвинулись дальше slack
+    map_h, map_w = grid.shape
+    tile = tile_w if axis == 0 else tile_h
+    edge = -1
+    for row in range(max(0, y // tile_h), min(map_h, (y + size - 1) // tile_h + 1)):
+        for col in range(max(0, x // tile_w), min(map_w, (x + size - 1) // tile_w + 1)):
+            if not grid[row, col]:
+                continue
+            cell = col if axis == 0 else row
+            near = (cell + 1) * tile if step < 0 else cell * tile
+            if edge == -1 or (step < 0 and near > edge) or (step > 0 and near < edge):
+                edge = near
+    # Клетки одной строки идут подряд по ключам, поэтому строка ищется одним отрезком
+    col0 = cell_index(x - size - slack, tile_w, map_w)
+    col1 = cell_index(x + size + slack, tile_w, map_w)
+    for row in range(cell_index(y - size - slack, tile_h, map_h),
+                     cell_index(y + size + slack, tile_h, map_h) + 1):
+        for k in range(np.searchsorted(keys, row * map_w + col0),
+                       np.searchsorted(keys, row * map_w + col1, side='right')):
+            if owners[k] != i:
+                edge = overlap_edge(boxes, owners[k], edge, x, y, size, step, axis)
+    for k in range(jumps):
+        if jumped[k] != i:
+            edge = overlap_edge(boxes, jumped[k], edge, x, y, size, step, axis)
+    return edge
+
+
+@njit(cache=True)
+def bucket_boxes(boxes, alive, tile_w, tile_h, map_w, map_h):
+    # Живые враги по клеткам левого верхнего угла ректа: отсортированные ключи клеток и номера
+    # врагов, поиск по ключу - через searchsorted, как в sweep_bullets. Углы за картой попадают
+    # в крайние клетки
+    indices = np.flatnonzero(alive)
+    keys = np.empty(indices.shape[0], dtype=np.int64)
+    for k in range(indices.shape[0]):
+        i = indices[k]
+        keys[k] = (cell_index(boxes[i, 1], tile_h, map_h) * map_w +
+                   cell_index(boxes[i, 0], tile_w, map_w))
+    order = np.argsort(keys, kind='mergesort')
+    return keys[order], indices[order]
+
+
+@njit(cache=True)
+def move_enemies(indices, boxes, velocities, alive, grid, tile_w, tile_h, size):
+    # Перемещает ректы столкновений врагов (левый верхний угол в boxes, сторона size) на их
+    # смещение за шаг по очереди, как Character.movement: сначала по x, затем по y, упираясь в
+    # ближайшую стену или другого живого врага. Координаты округляются так же, как в pygame.Rect.
+    # Корзины врагов строятся один раз до перемещения, поэтому соседи ищутся с запасом slack
+    # на самое большое смещение за шаг. Враг, который уже пересекался со стеной или другим
+    # врагом (например, в точке спавна), выталкивается к их границе и может сдвинуться дальше,
+    # такие враги проверяются отдельным списком jumped
+    map_h, map_w = grid.shape
+    keys, owners = bucket_boxes(boxes, alive, tile_w, tile_h, map_w, map_h)
+    slack = 0
+    for k in range(indices.shape[0]):
+        i = indices[k]
+        slack = max(slack, int(max(abs(velocities[i, 0]), abs(velocities[i, 1]))) + 1)
+    jumped = np.empty(indices.shape[0], dtype=np.int64)
+    jumps = 0
+    for k in range(indices.shape[0]):
+        i = indices[k]
+        x, y = boxes[i, 0], boxes[i, 1]
+        dx, dy = velocities[i, 0], velocities[i, 1]
+
+        new_x = int(floor(x + dx + 0.5))
+        if dx != 0:
+            edge = blocking_edge(boxes, keys, owners, slack, jumped, jumps, i, new_x, y, size,
+                                 dx, 0, grid, tile_w, tile_h)
+            if edge != -1:
+                new_x = edge if dx < 0 else edge - size
+        new_y = int(floor(y + dy + 0.5))
+        if dy != 0:
+            edge = blocking_edge(boxes, keys, owners, slack, jumped, jumps, i, new_x, new_y,
+                                 size, dy, 1, grid, tile_w, tile_h)
+            if edge != -1:
+                new_y = edge if dy < 0 else edge - size
+
+        # Если враг проскочил сквозь стену за один шаг, он остается на месте
+        if in_view_grid(x, y, new_x, new_y, grid, tile_w, tile_h):
+            boxes[i, 0], boxes[i, 1] = new_x, new_y
+            if max(abs(new_x - x), abs(new_y - y)) > slack:
+                jumped[jumps] = i
+                jumps += 1
+
+
+@njit(cache=True)
+def segment_wall(x0, y0, x1, y1, grid, tile_w, tile_h):
+    # Первая клетка стены на отрезке (x0, y0) - (x1, y1), обход клеток как в ray_hit_dda.
+    # Возвращает долю отрезка t до входа в стену и True, если вход через горизонтальную грань
+    # (сменилась строка), или t = -1, если стен на отрезке нет. Выход за карту считается стеной
+    map_h, map_w = grid.shape
+    col, row = int(x0) // tile_w, int(y0) // tile_h
+    dx, dy = x1 - x0, y1 - y0
+    step_col = 1 if dx > 0 else -1
+    step_row = 1 if dy > 0 else -1
+    if dx != 0:
+        t_col = ((col + (dx > 0)) * tile_w - x0) / dx
+        dt_col = tile_w / abs(dx)
+    else:
+        t_col = dt_col = np.inf
+    if dy != 0:
+        t_row = ((row + (dy > 0)) * tile_h - y0) / dy
+        dt_row = tile_h / abs(dy)
+    else:
+        t_row = dt_row = np.inf
+    while True:
+        if t_col < t_row:
+            t, horizontal = t_col, False
+            col += step_col
+            t_col += dt_col
+        else:
+            t, horizontal = t_row, True
+            row += step_row
+            t_row += dt_row
+        if t > 1:
+            return -1.0, False
+        if not (0 <= col < map_w and 0 <= row < map_h) or grid[row, col]:
+            return t, horizontal
+
+
+@njit(cache=True)
+def segment_rect(x0, y0, x1, y1, x, y, w, h):
+    # Доля отрезка (x0, y0) - (x1, y1) до входа в рект (x, y, w, h), -1 - отрезок его не задевает
+    t_in, t_out = 0.0, 1.0
+    for start, delta, low, high in ((x0, x1 - x0, x, x + w), (y0, y1 - y0, y, y + h)):
+        if delta == 0:
+            if start < low or start >= high:
+                return -1.0
+            continue
+        t0, t1 = (low - start) / delta, (high - start) / delta
+        if t0 > t1:
+            t0, t1 = t1, t0
+        t_in, t_out = max(t_in, t0), min(t_out, t1)
+        if t_in > t_out:
+            return -1.0
+    return t_in
+
+
+@njit(cache=True)
+def sweep_bullets(x0, y0, x1, y1, dmg, rects, hp, tile_w, tile_h, map_w, targets):
+    # Попадания пуль, пролетевших за шаг из (x0, y0) в (x1, y1), по ректам врагов. Враги
+    # раскладываются по клеткам уровня, которые задевают их ректы (отсортированные ключи клеток),
+    # и каждая пуля проверяет только врагов из клеток в рамке своего отрезка. Пуля попадает
+    # в первого врага на отрезке и сразу снимает ему hp, поэтому следующие пули пролетают сквозь
+    # убитого. В targets записывается номер врага в rects или -1. Ректы задаются в целых пикселях,
+    # как у спрайтов: последняя клетка ректа - клетка пикселя x + w - 1
+    n = rects.shape[0]
+    bounds = np.empty((n, 4), dtype=np.int64)  # Клетки ректа: col0, row0, col1, row1
+    count = 0
+    for j in range(n):
+        bounds[j, 0] = int(rects[j, 0]) // tile_w
+        bounds[j, 1] = int(rects[j, 1]) // tile_h
+        bounds[j, 2] = int(rects[j, 0] + rects[j, 2] - 1) // tile_w
+        bounds[j, 3] = int(rects[j, 1] + rects[j, 3] - 1) // tile_h
+        count += (bounds[j, 2] - bounds[j, 0] + 1) * (bounds[j, 3] - bounds[j, 1] + 1)
+    keys = np.empty(count, dtype=np.int64)
+    owners = np.empty(count, dtype=np.int64)
+    k = 0
+    for j in range(n):
+        for row in range(bounds[j, 1], bounds[j, 3] + 1):
+            for col in range(bounds[j, 0], bounds[j, 2] + 1):
+                keys[k], owners[k] = row * map_w + col, j
+                k += 1
+    order = np.argsort(keys, kind='mergesort')
+    keys, owners = keys[order], owners[order]
+
+    for b in range(x0.shape[0]):
+        targets[b] = -1
+        best = 2.0
+        col0, col1 = int(min(x0[b], x1[b])) // tile_w, int(max(x0[b], x1[b])) // tile_w
+        row0, row1 = int(min(y0[b], y1[b])) // tile_h, int(max(y0[b], y1[b])) // tile_h
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                key = row * map_w + col
+                for k in range(np.searchsorted(keys, key),
+                               np.searchsorted(keys, key, side='right')):
+                    j = owners[k]
+                    if hp[j] <= 0:
+                        continue
+                    t = segment_rect(x0[b], y0[b], x1[b], y1[b],
+                                     rects[j, 0], rects[j, 1], rects[j, 2], rects[j, 3])
+                    if 0 <= t < best:
+                        best, targets[b] = t, j
+        if targets[b] >= 0:
+            hp[targets[b]] -= dmg[b]
@@ -0,0 +1,45 @@
+from time import perf_counter
+from numba import types
+from RayCasting import (ray_fan_cycle, ray_fan_dda, collapse_vertices, screen_frame,
+                        visibility_polygon, in_view_grid, in_view_batch, build_pvs)
+from PathFinding import flow_field, think_enemies
+from Particles import update_particles
+from Collisions import move_enemies, sweep_bullets
+
+# Типы аргументов, с которыми ядра вызываются из игры. Все ядра объявлены с cache=True, поэтому
+# скомпилированный код сохраняется в __pycache__ и при следующих запусках только загружается
+f8, i8 = types.float64, types.int64
+f8_1d, f8_2d = types.float64[::1], types.float64[:, ::1]
+i8_1d, i8_2d = types.int64[::1], types.int64[:, ::1]
+i4_2d, i4_3d = types.int32[:, ::1], types.int32[:, :, ::1]
+b1_1d, b1_2d = types.boolean[::1], types.boolean[:, ::1]
+u1_2d = types.uint8[:, ::1]
+obstacles = types.ListType(types.UniTuple(i8, 4))
+
+SIGNATURES = (
+    (screen_frame, (f8, f8, f8, i8, i8, i4_2d)),
+    (ray_fan_dda, (i8, i8, i8, i8, b1_2d, i8, i8, i4_2d, i8)),
+    (ray_fan_cycle, (i8, i8, i8, i8, obstacles, i8, i8, i8, i8, i4_2d, i8)),
+    (collapse_vertices, (i4_2d, i8, i8)),
+    (visibility_polygon, (f8, f8, f8, f8_2d, i8)),
+    (in_view_grid, (i8, i8, i8, i8, b1_2d, i8, i8)),
+    (in_view_batch, (f8_2d, b1_2d, u1_2d, i8, i8)),
+    (build_pvs, (b1_2d, i8, i8)),
+    (flow_field, (b1_2d, i8, i8, i4_2d, i4_3d)),
+    (think_enemies, (i8, i8, f8_2d, i8_2d, f8_2d, f8_1d, i8, i8, b1_2d, u1_2d, i4_3d, i8, i8,
+                     i8, i8, b1_1d, i8_2d, f8_1d, f8_2d)),
+    (update_particles, (f8_1d, f8_1d, f8_1d, f8_1d, f8_1d, f8_1d, f8_1d, f8_1d, f8_1d, b1_1d,
+                        b1_2d, i8, i8)),
+    (move_enemies, (i8_1d, i8_2d, f8_2d, b1_1d, b1_2d, i8, i8, i8)),
+    (sweep_bullets, (f8_1d, f8_1d, f8_1d, f8_1d, f8_1d, f8_2d, f8_1d, i8, i8, i8, i8_1d)),
+)
+
+
+def warm_up():
+    # Компилирует ядра заранее (или загружает их из кэша) и возвращает время на каждое в секундах
+    times = {}
+    for kernel, signature in SIGNATURES:
+        start = perf_counter()
+        kernel.compile(signature)
+        times[kernel.__name__] = perf_counter() - start
+    return times
@@ -0,0 +1,149 @@
+import os
+import sys
+import hashlib
+import numpy as np
+
+# Собранные уровни хранятся рядом с исходными картами. Сборка пересоздается, если изменился
+# исходный файл уровня
+BUNDLE_DIR = os.path.join('levels', 'compiled')
+WALL, SPAWN, PLAYER = '#', 'E', '@'
+# Сторона чанка в клетках: стены разбиваются на прямоугольники отдельно в каждом чанке, чтобы
+# игра могла загружать стены только тех чанков, которые рядом с экраном
+CHUNK_SIZE = 32
+
+
+def source_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def parse_map(text):
+    # Возвращает строки карты одинаковой длины: короткие строки дополняются пустыми клетками
+    rows = [row.rstrip() for row in text.splitlines()]
+    while rows and not rows[-1]:
+        rows.pop()
+    width = max(len(row) for row in rows)
+    return [row.ljust(width) for row in rows]
+
+
+def find_cells(rows, char):
+    # Клетки (col, row) с символом char в порядке обхода карты по строкам
+    cells = [(col, row) for row, line in enumerate(rows)
+             for col, value in enumerate(line) if value == char]
+    return np.array(cells, dtype=np.int32).reshape(-1, 2)
+
+
+def wall_rects(grid, chunk_size=CHUNK_SIZE):
+    # Покрытие стен прямоугольниками (col, row, w, h), каждый прямоугольник лежит в одном чанке.
+    # В чанке жадное разбиение строится по строкам и по столбцам (на транспонированной сетке),
+    # остается то, где прямоугольников меньше
+    map_h, map_w = grid.shape
+    rects = [np.empty((0, 4), dtype=np.int32)]
+    for row in range(0, map_h, chunk_size):
+        for col in range(0, map_w, chunk_size):
+            chunk = grid[row:row + chunk_size, col:col + chunk_size]
+            by_rows = greedy_mesh(chunk)
+            by_cols = greedy_mesh(chunk.T)[:, [1, 0, 3, 2]]
+            best = by_rows if len(by_rows) <= len(by_cols) else by_cols
+            rects.append(best + np.array((col, row, 0, 0), dtype=np.int32))
+    return np.concatenate(rects)
+
+
+def greedy_mesh(grid):
+    # Покрывает стены прямоугольниками (col, row, w, h) в клетках: от первой непокрытой клетки
+    # прямоугольник растет вправо, пока идут стены, затем вниз, пока вся строка под ним - стены.
+    # Прямоугольники не пересекаются и покрывают каждую клетку стены
+    covered = ~grid
+    rects = []
+    map_h, map_w = grid.shape
+    for row in range(map_h):
+        for col in range(map_w):
+            if covered[row, col]:
+                continue
+            width = 1
+            while col + width < map_w and not covered[row, col + width]:
+                width += 1
+            height = 1
+            while row + height < map_h and not covered[row + height, col:col + width].any():
+                height += 1
+            covered[row:row + height, col:col + width] = True
+            rects.append((col, row, width, height))
+    return np.array(rects, dtype=np.int32).reshape(-1, 4)
+
+
+def get_runs(line):
+    # Возвращает отрезки [start, end) подряд идущих True в строке
+    edges = np.diff(np.concatenate(([0], line.astype(np.int8), [0])))
+    return zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1))
+
+
+def wall_segments(grid):
+    # Контур стен в виде отрезков (x1, y1, x2, y2) в клетках. Соседние ребра на одной линии
+    # со стеной с одной стороны склеиваются, поэтому отрезки не пересекаются
+    map_h, map_w = grid.shape
+    padded = np.pad(grid, 1, constant_values=True)
+    segments = []
+    for row in range(map_h + 1):
+        above, below = padded[row, 1:-1], padded[row + 1, 1:-1]
+        for edge in (above & ~below, below & ~above):
+            segments.extend((start, row, end, row) for start, end in get_runs(edge))
+    for col in range(map_w + 1):
+        left, right = padded[1:-1, col], padded[1:-1, col + 1]
+        for edge in (left & ~right, right & ~left):
+            segments.extend((col, start, col, end) for start, end in get_runs(edge))
+    return np.array(segments, dtype=np.float64).reshape(-1, 4)
+
+
+def compile_level(text, chunk_size=CHUNK_SIZE):
+    # Собирает уровень из текста карты в словарь массивов
+    rows = parse_map(text)
+    grid = np.array([[value == WALL for value in line] for line in rows], dtype=np.bool_)
+    return {
+        'grid': grid,
+        'rects': wall_rects(grid, chunk_size),
+        'chunk_size': np.array(chunk_size),
+        'spawns': find_cells(rows, SPAWN),
+        'player': find_cells(rows, PLAYER)[:1],
+        'segments': wall_segments(grid),
+        'source_hash': np.array(source_hash(text)),
+    }
+
+
+def bundle_path(path, bundle_dir=BUNDLE_DIR):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(bundle_dir, f'{name}.npz')
+
+
+def save_bundle(bundle, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    np.savez(target, **bundle)
+
+
+def build(path, bundle_dir=BUNDLE_DIR):
+    # Собирает уровень из файла и сохраняет сборку, возвращает путь к ней
+    with open(path) as file:
+        bundle = compile_level(file.read())
+    target = bundle_path(path, bundle_dir)
+    save_bundle(bundle, target)
+    return target
+
+
+def load_level(path, bundle_dir=BUNDLE_DIR):
+    # Загружает сборку уровня. Если сборки нет или исходный файл изменился, уровень
+    # собирается заново
+    with open(path) as file:
+        text = file.read()
+    target = bundle_path(path, bundle_dir)
+    if os.path.isfile(target):
+        with np.load(target) as data:
+            if (str(data['source_hash']) == source_hash(text) and
+                    'chunk_size' in data.files and int(data['chunk_size']) == CHUNK_SIZE):
+                return {key: data[key] for key in data.files}
+    bundle = compile_level(text)
+    save_bundle(bundle, target)
+    return bundle
+
+
+if __name__ == '__main__':
+    # python LevelCompiler.py levels/level_1.txt ... - собрать уровни заранее
+    for level_path in sys.argv[1:]:
+        print(build(level_path))
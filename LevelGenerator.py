@@ -0,0 +1,167 @@
+import os
+import argparse
+import numpy as np
+from PathFinding import flow_field, WALL as PATH_WALL, INF
+from LevelCompiler import WALL, SPAWN, PLAYER
+
+# Набор карт для замеров: каждая следующая карта больше предыдущей в 16 раз по числу клеток.
+# Карты собираются с одним seed, поэтому набор одинаков на любой машине
+CORPUS_DIR = os.path.join('levels', 'generated')
+CORPUS_SEED = 0
+CORPUS = (
+    # Имя, ширина, высота, комнаты, точки спавна
+    ('small', 40, 30, 4, 4),
+    ('medium', 160, 120, 24, 16),
+    ('large', 640, 480, 160, 64),
+    ('huge', 2560, 1920, 1000, 256),
+)
+# Доля свободных клеток, которые становятся случайными стенами
+DENSITY = 0.05
+# Наименьшая сторона комнаты и ширина коридора в клетках
+ROOM_MIN = 4
+CORRIDOR_WIDTH = 2
+# Точки спавна ставятся не ближе SPAWN_DISTANCE шагов от игрока, если на карте есть такие клетки
+SPAWN_DISTANCE = 8
+# Сколько клеток пробуется на место игрока: выбирается та, из которой доступно больше клеток
+PLAYER_TRIES = 8
+
+
+def place_rooms(width, height, rooms, rng):
+    # Случайные комнаты (col, row, w, h) внутри рамки карты, между комнатами остается хотя бы одна
+    # клетка стены. Если места нет, комнат будет меньше
+    side = max(ROOM_MIN, int((width * height / rooms) ** 0.5 * 0.7))
+    taken = np.zeros((height, width), dtype=np.bool_)
+    placed = []
+    for _ in range(rooms * 20):
+        if len(placed) == rooms:
+            break
+        w, h = rng.integers(ROOM_MIN, side + 1, size=2)
+        if w > width - 2 or h > height - 2:
+            continue
+        col, row = rng.integers(1, width - w), rng.integers(1, height - h)
+        if taken[row - 1:row + h + 1, col - 1:col + w + 1].any():
+            continue
+        taken[row:row + h, col:col + w] = True
+        placed.append((col, row, w, h))
+    return placed
+
+
+def connect_rooms(shape, rooms, rng):
+    # Коридоры в форме буквы Г: каждая комната соединяется с ближайшей из уже соединенных,
+    # поэтому из любой комнаты можно дойти до любой
+    corridors = np.zeros(shape, dtype=np.bool_)
+    height, width = shape
+    centers = np.array([(col + w // 2, row + h // 2) for col, row, w, h in rooms]).reshape(-1, 2)
+    centers = np.minimum(centers, (width - 1 - CORRIDOR_WIDTH, height - 1 - CORRIDOR_WIDTH))
+    for i in range(1, len(centers)):
+        j = int(np.argmin(np.abs(centers[:i] - centers[i]).sum(axis=1)))
+        (x1, y1), (x2, y2) = centers[i], centers[j]
+        corner = (x2, y1) if rng.random() < 0.5 else (x1, y2)
+        for (ax, ay), (bx, by) in (((x1, y1), corner), (corner, (x2, y2))):
+            corridors[min(ay, by):max(ay, by) + CORRIDOR_WIDTH,
+                      min(ax, bx):max(ax, bx) + CORRIDOR_WIDTH] = True
+    return corridors
+
+
+def reachable_from(grid, cell):
+    # Клетки, до которых можно дойти из cell (col, row), и расстояния до них
+    distances = np.empty(grid.shape, dtype=np.int32)
+    directions = np.empty(grid.shape + (2,), dtype=np.int32)
+    flow_field(grid, cell[1], cell[0], distances, directions)
+    return (distances != PATH_WALL) & (distances != INF), distances
+
+
+def place_player(grid, rng):
+    # Игрок ставится в свободную клетку, из которой доступна большая часть карты
+    free = np.flatnonzero(~grid)
+    best = None
+    for index in rng.choice(free, size=min(PLAYER_TRIES, len(free)), replace=False):
+        cell = int(index % grid.shape[1]), int(index // grid.shape[1])
+        reachable, distances = reachable_from(grid, cell)
+        if best is None or reachable.sum() > best[1].sum():
+            best = cell, reachable, distances
+        if reachable.sum() * 2 >= len(free):
+            break
+    return best
+
+
+def generate(width, height, density=DENSITY, rooms=0, spawns=4, seed=0):
+    # Возвращает карту в формате файлов levels/level_N.txt. Если rooms = 0, карта - открытое поле,
+    # иначе - комнаты, соединенные коридорами. density - доля клеток со случайными стенами внутри
+    # свободного места (коридоры не перекрываются). Области, до которых игрок не может дойти,
+    # заливаются стенами
+    if width < 3 or height < 3:
+        raise ValueError('map must be at least 3x3 cells')
+    rng = np.random.default_rng(seed)
+    if rooms:
+        grid = np.ones((height, width), dtype=np.bool_)
+        placed = place_rooms(width, height, rooms, rng)
+        for col, row, w, h in placed:
+            grid[row:row + h, col:col + w] = False
+        corridors = connect_rooms(grid.shape, placed, rng)
+        grid &= ~corridors
+    else:
+        grid = np.zeros((height, width), dtype=np.bool_)
+        corridors = np.zeros_like(grid)
+    grid |= (rng.random(grid.shape) < density) & ~corridors
+    grid[[0, -1], :] = grid[:, [0, -1]] = True
+    if grid.all():
+        raise ValueError('map has no free cells')
+
+    player, reachable, distances = place_player(grid, rng)
+    grid |= ~reachable
+
+    # Точки спавна - случайные доступные клетки, по возможности дальше SPAWN_DISTANCE от игрока
+    far = np.flatnonzero(reachable & (distances >= SPAWN_DISTANCE))
+    if len(far) < spawns:
+        far = np.flatnonzero(reachable & (distances > 0))
+    spawn_cells = rng.choice(far, size=min(spawns, len(far)), replace=False)
+
+    chars = np.where(grid, WALL, ' ')
+    chars.flat[spawn_cells] = SPAWN
+    chars[player[1], player[0]] = PLAYER
+    return '\n'.join(''.join(line) for line in chars) + '\n'
+
+
+def write_level(path, text):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(text)
+    return path
+
+
+def generate_corpus(target_dir=CORPUS_DIR, seed=CORPUS_SEED, density=DENSITY):
+    # Записывает карты CORPUS в target_dir и возвращает пути к ним
+    paths = []
+    for name, width, height, rooms, spawns in CORPUS:
+        text = generate(width, height, density, rooms, spawns, seed)
+        paths.append(write_level(os.path.join(target_dir, f'{name}.txt'), text))
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Procedural level generator')
+    parser.add_argument('--corpus', action='store_true',
+                        help=f'write the benchmark maps ({", ".join(c[0] for c in CORPUS)}) '
+                             f'to {CORPUS_DIR}')
+    parser.add_argument('--width', type=int, default=64)
+    parser.add_argument('--height', type=int, default=48)
+    parser.add_argument('--density', type=float, default=DENSITY,
+                        help='share of free cells turned into random walls')
+    parser.add_argument('--rooms', type=int, default=0,
+                        help='number of rooms joined by corridors, 0 for an open field')
+    parser.add_argument('--spawns', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file for the map, stdout if omitted')
+    args = parser.parse_args()
+
+    if args.corpus:
+        for level_path in generate_corpus(seed=args.seed, density=args.density):
+            print(level_path)
+    else:
+        level_text = generate(args.width, args.height, args.density, args.rooms, args.spawns,
+                              args.seed)
+        if args.output:
+            print(write_level(args.output, level_text))
+        else:
+            print(level_text, end='')
@@ -0,0 +1,44 @@
+from math import pi
+from numba import njit
+from Collisions import segment_wall
+
+# На сколько пикселей объект останавливается перед стеной при рикошете
+WALL_GAP = 0.5
+
+
+@njit(fastmath=True, cache=True)
+def update_particles(x, y, dx, dy, phi, cos_phi, sin_phi, v, a, alive, grid, tile_w, tile_h):
+    # Один проход по всем летающим объектам: проверка остановки, рикошет от стен и перемещение.
+    # Стены ищутся на всем отрезке перемещения, поэтому быстрые объекты не пролетают сквозь них
+    map_h, map_w = grid.shape
+    for i in range(x.shape[0]):
+        if not alive[i]:
+            continue
+        if v[i] <= 0:
+            alive[i] = False
+            continue
+
+        end_x, end_y = x[i] + v[i] * cos_phi[i], y[i] + v[i] * sin_phi[i]
+        col, row = int(x[i]) // tile_w, int(y[i]) // tile_h
+        if not (0 <= col < map_w and 0 <= row < map_h) or grid[row, col]:
+            # Объект появился внутри стены (выстрел в упор)
+            alive[i] = False
+            continue
+        t, horizontal = segment_wall(x[i], y[i], end_x, end_y, grid, tile_w, tile_h)
+        if t >= 0:
+            # Рикошет: объект останавливается у стены, а направление отражается относительно
+            # грани, через которую он вошел бы в стену
+            t = max(0.0, t - WALL_GAP / v[i])
+            end_x, end_y = x[i] + (end_x - x[i]) * t, y[i] + (end_y - y[i]) * t
+            if horizontal:
+                sin_phi[i] = -sin_phi[i]
+                phi[i] = -phi[i]
+            else:
+                phi[i] = pi - phi[i]
+                cos_phi[i] = -cos_phi[i]
+            v[i] -= 5
+
+        dx[i] = end_x - x[i]
+        dy[i] = end_y - y[i]
+        x[i], y[i] = end_x, end_y
+        v[i] += a[i]
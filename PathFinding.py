@@ -0,0 +1,85 @@
+from math import atan2, cos, sin
+import numpy as np
+from numba import njit
+from RayCasting import in_view_grid, pvs_visible
+
+# Соседние клетки в порядке проверки: вверх, вниз, влево, вправо
+NEIGHBOURS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+WALL = -1
+INF = 2 ** 31 - 1  # Больше длины любого пути: расстояния хранятся в int32
+
+
+@njit(cache=True)
+def flow_field(walls, start_row, start_col, distances, directions):
+    # Поиск в ширину от клетки игрока. Заполняет матрицу расстояний и поле направлений: для каждой
+    # клетки - координаты (col, row) соседней клетки, которая ближе к игроку
+    map_h, map_w = walls.shape
+    for row in range(map_h):
+        for col in range(map_w):
+            distances[row, col] = WALL if walls[row, col] else INF
+    distances[start_row, start_col] = 0
+
+    queue = np.empty(map_h * map_w, dtype=np.int64)
+    queue[0] = start_row * map_w + start_col
+    head, tail = 0, 1
+    while head < tail:
+        row, col = queue[head] // map_w, queue[head] % map_w
+        head += 1
+        for dr, dc in NEIGHBOURS:
+            next_row, next_col = row + dr, col + dc
+            if (0 <= next_row < map_h and 0 <= next_col < map_w and
+                    distances[next_row, next_col] == INF):
+                distances[next_row, next_col] = distances[row, col] + 1
+                queue[tail] = next_row * map_w + next_col
+                tail += 1
+
+    for row in range(map_h):
+        for col in range(map_w):
+            # Если более близкой клетки нет, враг остается на месте
+            directions[row, col, 0], directions[row, col, 1] = col, row
+            if distances[row, col] == WALL:
+                continue
+            for dr, dc in NEIGHBOURS:
+                next_row, next_col = row + dr, col + dc
+                if (0 <= next_row < map_h and 0 <= next_col < map_w and
+                        distances[next_row, next_col] != WALL and
+                        distances[next_row, next_col] < distances[row, col]):
+                    directions[row, col, 0], directions[row, col, 1] = next_col, next_row
+                    break
+
+
+@njit(nogil=True, cache=True)
+def think_enemies(start, end, rects, cells, centers, speeds, target_x, target_y, grid, pvs,
+                  directions, origin_col, origin_row, tile_w, tile_h, in_view, destinations,
+                  angles, velocities):
+    # Решения врагов с номерами [start, end): видят ли они игрока из всех 4-х углов спрайта,
+    # следующая клетка пути (col, row) и направление движения. Каждый враг пишет только свою
+    # строку выходных массивов, поэтому части можно считать в разных потоках без GIL.
+    # Поле направлений покрывает окно карты с левой верхней клеткой (origin_col, origin_row)
+    # в координатах окна, враг вне окна идет прямо к клетке игрока
+    window_h, window_w = directions.shape[0], directions.shape[1]
+    for i in range(start, end):
+        x, y, w, h = rects[i, 0], rects[i, 1], rects[i, 2], rects[i, 3]
+        visible = True
+        for corner_x, corner_y in ((x, y), (x + w, y), (x + w, y + h), (x, y + h)):
+            if not (pvs_visible(corner_x, corner_y, target_x, target_y, grid, pvs,
+                                tile_w, tile_h) and
+                    in_view_grid(corner_x, corner_y, target_x, target_y, grid, tile_w, tile_h)):
+                visible = False
+                break
+        in_view[i] = visible
+
+        row, col = cells[i, 1] // tile_h - origin_row, cells[i, 0] // tile_w - origin_col
+        if 0 <= row < window_h and 0 <= col < window_w:
+            destinations[i, 0] = directions[row, col, 0] + origin_col
+            destinations[i, 1] = directions[row, col, 1] + origin_row
+        else:
+            destinations[i, 0], destinations[i, 1] = target_x // tile_w, target_y // tile_h
+        if visible:
+            angle = atan2(target_y - centers[i, 1], target_x - centers[i, 0])
+        else:
+            angle = atan2(destinations[i, 1] * tile_h + tile_h // 2 - centers[i, 1],
+                          destinations[i, 0] * tile_w + tile_w // 2 - centers[i, 0])
+        angles[i] = angle
+        velocities[i, 0] = cos(angle) * speeds[i]
+        velocities[i, 1] = sin(angle) * speeds[i]
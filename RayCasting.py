@@ -1,78 +1,444 @@
-from math import atan2, cos, sin, sqrt
-from numba import njit
+from math import atan2, cos, sin, sqrt, pi
+import numpy as np
+from numba import njit, prange
 
 
-@njit(fastmath=True)
-def ray_cycle(player_x, player_y, view_angle, obstacles, tile_w, tile_h, map_w, map_h, fov):
+# Число вершин рамки экрана, с которых начинается многоугольник тени в буфере лучей
+FRAME_VERTICES = 7
+
+
+@njit(fastmath=True, cache=True)
+def ray_hit_cycle(player_x, player_y, alpha, obstacles, tile_w, tile_h, map_w, map_h):
+    # Точка пересечения одного луча со стенками: перебор всех стенок на каждой линии сетки
     rounded_x = (player_x // tile_w) * tile_w
     rounded_y = (player_y // tile_h) * tile_h
-    coords = []
+    sin_a = sin(alpha) if sin(alpha) else 0.000001
+    cos_a = cos(alpha) if cos(alpha) else 0.000001
+
+    # Пересечение по вертикали
+    ray_x, dx = (rounded_x + tile_w, 1) if cos_a >= 0 else (rounded_x, -1)
+    ray_y = player_y
+    length_v = 0.0
+    found = False
+    for _ in range(0, map_w * tile_w, tile_w):
+        length_v = (ray_x - player_x) / cos_a
+        ray_y = player_y + length_v * sin_a
 
-    for alpha in range(-fov, fov + 1):  # Цикл по углу обзора
-        alpha = view_angle + alpha / 100
-        sin_a = sin(alpha) if sin(alpha) else 0.000001
-        cos_a = cos(alpha) if cos(alpha) else 0.000001
-        ray_x, ray_y = player_x, player_y
-
-        # Пересечение по вертикали
-        ray_x, dx = (rounded_x + tile_w, 1) if cos_a >= 0 else (rounded_x, -1)
-        found = False
-        for _ in range(0, map_w * tile_w, tile_w):
-            length_v = (ray_x - player_x) / cos_a
-            ray_y = player_y + length_v * sin_a
-
-            for ox, oy, map_w, map_h in obstacles:
-                if ox <= ray_x <= ox + map_w and oy <= ray_y <= oy + map_h:
-                    found = True
-                    break
-            if found:
+        for ox, oy, ow, oh in obstacles:
+            if ox <= ray_x <= ox + ow and oy <= ray_y <= oy + oh:
+                found = True
                 break
-            ray_x += tile_w * dx
-        res_v = (int(ray_x), int(ray_y), length_v)
-
-        # Пересечение по горизонтали
-        ray_y, dy = (rounded_y + tile_h, 1) if sin_a >= 0 else (rounded_y, -1)
-        found = False
-        for _ in range(0, map_h * tile_h, tile_h):
-            length_h = (ray_y - player_y) / sin_a
-            ray_x = player_x + length_h * cos_a
-
-            for ox, oy, map_w, map_h in obstacles:
-                if ox <= ray_x <= ox + map_w and oy <= ray_y <= oy + map_h:
-                    found = True
-                    break
-            if found:
+        if found:
+            break
+        ray_x += tile_w * dx
+    res_v = (int(ray_x), int(ray_y), length_v)
+
+    # Пересечение по горизонтали
+    ray_y, dy = (rounded_y + tile_h, 1) if sin_a >= 0 else (rounded_y, -1)
+    ray_x = player_x
+    length_h = 0.0
+    found = False
+    for _ in range(0, map_h * tile_h, tile_h):
+        length_h = (ray_y - player_y) / sin_a
+        ray_x = player_x + length_h * cos_a
+
+        for ox, oy, ow, oh in obstacles:
+            if ox <= ray_x <= ox + ow and oy <= ray_y <= oy + oh:
+                found = True
                 break
-            ray_y += tile_h * dy
-        res_h = (int(ray_x), int(ray_y), length_h)
+        if found:
+            break
+        ray_y += tile_h * dy
+    res_h = (int(ray_x), int(ray_y), length_h)
+
+    return (res_v[0], res_v[1]) if res_v[2] <= res_h[2] else (res_h[0], res_h[1])
 
-        res = (res_v[0], res_v[1]) if res_v[2] <= res_h[2] else (res_h[0], res_h[1])
 
-        if (len(coords) > 1 and (coords[-1][0] == res[0] and coords[-2][0] == res[0] or
-                                 coords[-1][1] == res[1] and coords[-2][1] == res[1])):
-            coords[-1] = res
+@njit(fastmath=True, cache=True)
+def ray_hit_dda(player_x, player_y, alpha, grid, tile_w, tile_h):
+    # Точка пересечения одного луча со стенами по сетке занятости (алгоритм Amanatides–Woo):
+    # луч проходит только по тем клеткам, которые он пересекает, без перебора всех стенок
+    map_h, map_w = grid.shape
+    sin_a = sin(alpha) if sin(alpha) else 0.000001
+    cos_a = cos(alpha) if cos(alpha) else 0.000001
+
+    col, row = int(player_x // tile_w), int(player_y // tile_h)
+    if cos_a >= 0:
+        dx = 1
+        t_max_x = ((col + 1) * tile_w - player_x) / cos_a
+    else:
+        dx = -1
+        t_max_x = (col * tile_w - player_x) / cos_a
+    if sin_a >= 0:
+        dy = 1
+        t_max_y = ((row + 1) * tile_h - player_y) / sin_a
+    else:
+        dy = -1
+        t_max_y = (row * tile_h - player_y) / sin_a
+    t_delta_x = tile_w / abs(cos_a)
+    t_delta_y = tile_h / abs(sin_a)
+
+    vertical = True
+    while 0 <= col < map_w and 0 <= row < map_h and not grid[row, col]:
+        # Переходим в соседнюю клетку через ближайшую границу
+        vertical = t_max_x <= t_max_y
+        if vertical:
+            t_max_x += t_delta_x
+            col += dx
         else:
-            coords.append(res)
-    return coords
+            t_max_y += t_delta_y
+            row += dy
+
+    # Точка пересечения считается от линии сетки, как и в ray_hit_cycle
+    if vertical:
+        ray_x = col * tile_w if dx > 0 else (col + 1) * tile_w
+        ray_y = player_y + (ray_x - player_x) / cos_a * sin_a
+    else:
+        ray_y = row * tile_h if dy > 0 else (row + 1) * tile_h
+        ray_x = player_x + (ray_y - player_y) / sin_a * cos_a
+    return int(ray_x), int(ray_y)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def ray_fan_cycle(player_x, player_y, first, count, obstacles, tile_w, tile_h, map_w, map_h,
+                  out, start):
+    # Лучи перебором стенок (ray_hit_cycle) считаются параллельно и записываются в буфер out
+    # (N x 2) начиная со строки start, без склейки вершин. Лучи идут под углами (first + i) / 100,
+    # i < count: углы лучей кратны шагу, поэтому лучи соседних кадров можно переиспользовать
+    for i in prange(count):
+        x, y = ray_hit_cycle(player_x, player_y, (first + i) / 100, obstacles,
+                             tile_w, tile_h, map_w, map_h)
+        out[start + i, 0], out[start + i, 1] = x, y
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def ray_fan_dda(player_x, player_y, first, count, grid, tile_w, tile_h, out, start):
+    # То же, что ray_fan_cycle, но точки пересечения ищутся обходом сетки (ray_hit_dda)
+    for i in prange(count):
+        x, y = ray_hit_dda(player_x, player_y, (first + i) / 100, grid, tile_w, tile_h)
+        out[start + i, 0], out[start + i, 1] = x, y
+
+
+@njit(cache=True)
+def collapse_vertices(out, start, end):
+    # Склейка вершин на месте для строк буфера [start, end): точки на одной прямой с двумя
+    # предыдущими заменяют последнюю точку. Возвращает номер строки после последней вершины
+    count = start
+    for i in range(start, end):
+        x, y = out[i, 0], out[i, 1]
+        if (count - start > 1 and (out[count - 1, 0] == x and out[count - 2, 0] == x or
+                                   out[count - 1, 1] == y and out[count - 2, 1] == y)):
+            out[count - 1, 0], out[count - 1, 1] = x, y
+        else:
+            out[count, 0], out[count, 1] = x, y
+            count += 1
+    return count
+
+
+@njit(cache=True)
+def screen_frame(x, y, alpha, width, height, out):
+    # Записывает в начало буфера рамку экрана, которая вместе с точками лучей образует
+    # многоугольник тени вокруг области видимости. Возвращает число вершин рамки
+    if -pi <= alpha <= -pi / 2:
+        corners = ((width, height), (0, height), (0, 0), (width, 0), (width, height))
+    elif -pi / 2 <= alpha <= 0:
+        corners = ((0, height), (0, 0), (width, 0), (width, height), (0, height))
+    elif 0 <= alpha <= pi / 2:
+        corners = ((0, 0), (width, 0), (width, height), (0, height), (0, 0))
+    else:
+        corners = ((width, 0), (width, height), (0, height), (0, 0), (width, 0))
+    out[0, 0], out[0, 1] = x, y
+    for i in range(5):
+        out[i + 1, 0], out[i + 1, 1] = corners[i]
+    out[6, 0], out[6, 1] = x, y
+    return FRAME_VERTICES
+
+
+@njit(fastmath=True, cache=True)
+def in_view_grid(x1, y1, x2, y2, grid, tile_w, tile_h):
+    # Проверка видимости по сетке занятости: отрезок проходит по клеткам, которые он пересекает,
+    # вместо шага в 1 пиксель с перебором всех стенок
+    # Отрезок вдоль линии сетки касается стен с обеих сторон, но закрыт, только если не видно
+    # ни с одной из сторон
+    if y1 == y2 and y1 % tile_h == 0:
+        return (cells_clear(x1, y1 - 0.001, x2, y2 - 0.001, grid, tile_w, tile_h) or
+                cells_clear(x1, y1 + 0.001, x2, y2 + 0.001, grid, tile_w, tile_h))
+    if x1 == x2 and x1 % tile_w == 0:
+        return (cells_clear(x1 - 0.001, y1, x2 - 0.001, y2, grid, tile_w, tile_h) or
+                cells_clear(x1 + 0.001, y1, x2 + 0.001, y2, grid, tile_w, tile_h))
+    return cells_clear(x1, y1, x2, y2, grid, tile_w, tile_h)
+
+
+@njit(fastmath=True, cache=True)
+def cells_clear(x1, y1, x2, y2, grid, tile_w, tile_h):
+    # Обход клеток отрезка по алгоритму Amanatides–Woo
+    map_h, map_w = grid.shape
+    dx, dy = x2 - x1, y2 - y1
+    distance = sqrt(dx ** 2 + dy ** 2)
+    if distance == 0:
+        return True
+    # Концы отрезка чуть сдвигаются внутрь, чтобы точка на границе стены не считалась стеной
+    cos_phi, sin_phi = dx / distance, dy / distance
+    col = int((x1 + cos_phi * 0.001) // tile_w)
+    row = int((y1 + sin_phi * 0.001) // tile_h)
+    end_col = int((x2 - cos_phi * 0.001) // tile_w)
+    end_row = int((y2 - sin_phi * 0.001) // tile_h)
+
+    step_x = 1 if dx >= 0 else -1
+    step_y = 1 if dy >= 0 else -1
+    t_max_x = ((col + (step_x > 0)) * tile_w - x1) / dx if dx else 1e9
+    t_max_y = ((row + (step_y > 0)) * tile_h - y1) / dy if dy else 1e9
+    t_delta_x = abs(tile_w / dx) if dx else 1e9
+    t_delta_y = abs(tile_h / dy) if dy else 1e9
 
+    for _ in range(abs(end_col - col) + abs(end_row - row) + 1):
+        if not (0 <= col < map_w and 0 <= row < map_h) or grid[row, col]:
+            return False
+        if t_max_x < t_max_y:
+            t_max_x += t_delta_x
+            col += step_x
+        else:
+            t_max_y += t_delta_y
+            row += step_y
+    return True
 
-@njit(fastmath=True)
-def in_view(x1, y1, x2, y2, obstacles):
-    # Рейкаст, но с 1-ой линией, для проверки нахождения объекта в зоне видимости
-    phi = atan2(y2 - y1, x2 - x1)
-    cos_phi = cos(phi)
-    sin_phi = sin(phi)
-    distance = sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
 
-    length = 0
-    while distance > 1:
-        ray_x = x1 + length * cos_phi
-        ray_y = y1 + length * sin_phi
-        distance = sqrt((ray_x - x2) ** 2 + (ray_y - y2) ** 2)
+@njit(fastmath=True, cache=True)
+def in_view_batch(pairs, grid, pvs, tile_w, tile_h):
+    # Проверка видимости сразу для массива пар точек (x1, y1, x2, y2). Пары клеток, которые
+    # по PVS точно не видят друг друга, отсекаются без обхода сетки
+    result = np.empty(pairs.shape[0], dtype=np.bool_)
+    for i in range(pairs.shape[0]):
+        if not pvs_visible(pairs[i, 0], pairs[i, 1], pairs[i, 2], pairs[i, 3],
+                           grid, pvs, tile_w, tile_h):
+            result[i] = False
+        else:
+            result[i] = in_view_grid(pairs[i, 0], pairs[i, 1], pairs[i, 2], pairs[i, 3],
+                                     grid, tile_w, tile_h)
+    return result
+
 
-        for ox, oy, map_w, map_h in obstacles:
-            if ox < ray_x < ox + map_w and oy < ray_y < oy + map_h:
-                return False
-        length += 1
+@njit(cache=True)
+def crossing_range(ax0, ax1, ay0, ay1, bx0, bx1, by0, by1, x):
+    # Наименьшая и наибольшая y, в которых отрезки из прямоугольника a в прямоугольник b
+    # пересекают вертикаль x между ними. Это срез выпуклой оболочки прямоугольников, его края
+    # лежат на отрезках между углами
+    low, high = np.inf, -np.inf
+    for px in (ax0, ax1):
+        for qx in (bx0, bx1):
+            t = (x - px) / (qx - px)
+            for py in (ay0, ay1):
+                for qy in (by0, by1):
+                    y = py + (qy - py) * t
+                    low, high = min(low, y), max(high, y)
+    return low, high
 
+
+@njit(cache=True)
+def column_blocked(grid, col, low, high, tile_h):
+    # Все клетки столбца col от low до high - стены, за картой тоже стена. Запас в сотую клетки:
+    # отрезок вдоль линии сетки закрыт, только если стены с обеих сторон от нее
+    first = int((low - tile_h * 0.01) // tile_h)
+    last = int((high + tile_h * 0.01) // tile_h)
+    for row in range(first, last + 1):
+        if 0 <= row < grid.shape[0] and not grid[row, col]:
+            return False
     return True
+
+
+@njit(cache=True)
+def boxes_occluded(grid, ax0, ax1, ay0, ay1, bx0, bx1, by0, by1, tile_w, tile_h):
+    # True, если никакой отрезок из прямоугольника a в прямоугольник b не проходит мимо стен:
+    # между ними есть столбец или строка сетки, где стены закрывают весь срез оболочки
+    # прямоугольников по середине столбца (строки). Проверка консервативная: False не значит,
+    # что прямоугольники видят друг друга
+    if ax0 > bx0:
+        ax0, ax1, ay0, ay1, bx0, bx1, by0, by1 = bx0, bx1, by0, by1, ax0, ax1, ay0, ay1
+    for col in range(int(ax1 // tile_w), int(bx0 // tile_w) + 1):
+        x = (col + 0.5) * tile_w
+        if ax1 < x < bx0:
+            low, high = crossing_range(ax0, ax1, ay0, ay1, bx0, bx1, by0, by1, x)
+            if column_blocked(grid, col, low, high, tile_h):
+                return True
+    # Строки проверяются так же, как столбцы транспонированной сетки
+    if ay0 > by0:
+        ax0, ax1, ay0, ay1, bx0, bx1, by0, by1 = bx0, bx1, by0, by1, ax0, ax1, ay0, ay1
+    for row in range(int(ay1 // tile_h), int(by0 // tile_h) + 1):
+        y = (row + 0.5) * tile_h
+        if ay1 < y < by0:
+            low, high = crossing_range(ay0, ay1, ax0, ax1, by0, by1, bx0, bx1, y)
+            if column_blocked(grid.T, row, low, high, tile_w):
+                return True
+    return False
+
+
+@njit(cache=True)
+def build_pvs(grid, tile_w, tile_h):
+    # Потенциально видимые множества (PVS): бит [a, b] равен 1, если из клетки a может быть
+    # видна клетка b. Бит сбрасывается, только если boxes_occluded доказал, что клетки закрыты
+    # друг от друга, поэтому PVS не скрывает видимых пар. Биты упакованы по 8 в байт, как
+    # в np.packbits
+    map_h, map_w = grid.shape
+    n = map_h * map_w
+    pvs = np.zeros((n, (n + 7) // 8), dtype=np.uint8)
+    for a in range(n):
+        row_a, col_a = a // map_w, a % map_w
+        if grid[row_a, col_a]:
+            continue
+        for b in range(a, n):
+            row_b, col_b = b // map_w, b % map_w
+            if grid[row_b, col_b]:
+                continue
+            if not boxes_occluded(grid, col_a * tile_w, (col_a + 1) * tile_w,
+                                  row_a * tile_h, (row_a + 1) * tile_h,
+                                  col_b * tile_w, (col_b + 1) * tile_w,
+                                  row_b * tile_h, (row_b + 1) * tile_h, tile_w, tile_h):
+                pvs[a, b >> 3] |= 128 >> (b & 7)
+                pvs[b, a >> 3] |= 128 >> (a & 7)
+    return pvs
+
+
+@njit(fastmath=True, cache=True)
+def pvs_visible(x1, y1, x2, y2, grid, pvs, tile_w, tile_h):
+    # O(1) проверка по PVS: False - точки точно не видят друг друга, True - нужна точная проверка
+    map_h, map_w = grid.shape
+    if pvs.shape[0] != map_h * map_w:  # PVS не построен
+        return True
+    col_a, row_a = int(x1 // tile_w), int(y1 // tile_h)
+    col_b, row_b = int(x2 // tile_w), int(y2 // tile_h)
+    if not (0 <= col_a < map_w and 0 <= row_a < map_h and 0 <= col_b < map_w and
+            0 <= row_b < map_h) or grid[row_a, col_a] or grid[row_b, col_b]:
+        return True
+    a, b = row_a * map_w + col_a, row_b * map_w + col_b
+    return pvs[a, b >> 3] & (128 >> (b & 7)) != 0
+
+
+@njit(cache=True)
+def segment_distance(segments, i, player_x, player_y, cos_a, sin_a):
+    # Расстояние от игрока до отрезка стены вдоль луча с направлением (cos_a, sin_a)
+    x1, y1, x2, y2 = segments[i, 0], segments[i, 1], segments[i, 2], segments[i, 3]
+    sx, sy = x2 - x1, y2 - y1
+    denominator = cos_a * sy - sin_a * sx
+    if denominator == 0:
+        return 1e9
+    return ((x1 - player_x) * sy - (y1 - player_y) * sx) / denominator
+
+
+@njit(cache=True)
+def heap_swap(heap, position, i, j):
+    heap[i], heap[j] = heap[j], heap[i]
+    position[heap[i]] = i
+    position[heap[j]] = j
+
+
+@njit(cache=True)
+def heap_sift(heap, position, size, i, segments, player_x, player_y, cos_a, sin_a):
+    # Восстанавливает кучу активных отрезков (ближайший к игроку вдоль луча - в корне)
+    while i > 0:
+        parent = (i - 1) // 2
+        if (segment_distance(segments, heap[i], player_x, player_y, cos_a, sin_a) >=
+                segment_distance(segments, heap[parent], player_x, player_y, cos_a, sin_a)):
+            break
+        heap_swap(heap, position, i, parent)
+        i = parent
+    while True:
+        smallest = i
+        for child in (2 * i + 1, 2 * i + 2):
+            if child < size and (
+                    segment_distance(segments, heap[child], player_x, player_y, cos_a, sin_a) <
+                    segment_distance(segments, heap[smallest], player_x, player_y, cos_a, sin_a)):
+                smallest = child
+        if smallest == i:
+            break
+        heap_swap(heap, position, i, smallest)
+        i = smallest
+
+
+@njit(cache=True)
+def visibility_polygon(player_x, player_y, view_angle, segments, fov):
+    # Точный полигон видимости: угловой проход по концам отрезков стен в пределах угла обзора.
+    # Отрезки стен не пересекаются, поэтому порядок активных отрезков по удаленности не меняется
+    # между событиями, и ближайший отрезок лежит в корне кучи. Сложность - O(n log n)
+    start_angle = view_angle - fov / 100
+    width = 2 * fov / 100
+    n = segments.shape[0]
+
+    # События: угол, номер отрезка и тип (0 - отрезок начался, 1 - закончился)
+    event_angles = np.empty(2 * n + 2)
+    event_segments = np.full(2 * n + 2, -1, dtype=np.int64)
+    event_types = np.zeros(2 * n + 2, dtype=np.int64)
+    event_angles[0], event_angles[1] = 0.0, width  # Границы угла обзора
+    count = 2
+    for i in range(n):
+        # Угловой интервал отрезка относительно левой границы обзора
+        a1 = (atan2(segments[i, 1] - player_y, segments[i, 0] - player_x) - start_angle) % (2 * pi)
+        a2 = (atan2(segments[i, 3] - player_y, segments[i, 2] - player_x) - start_angle) % (2 * pi)
+        delta = (a2 - a1 + pi) % (2 * pi) - pi
+        if delta == 0 or abs(delta) >= pi:  # Отрезок лежит на одной прямой с игроком
+            continue
+        # Оба конца берутся прямо из atan2: у отрезков с общей вершиной конец одного и начало
+        # другого совпадают точно, и их порядок в куче не решается погрешностью
+        first, last = (a1, a2) if delta > 0 else (a2, a1)
+        if last < first:  # Отрезок пересекает левую границу обзора
+            first -= 2 * pi
+        if last <= 0 or first >= width:
+            continue
+        event_angles[count], event_segments[count] = max(first, 0.0), i
+        count += 1
+        if last < width:
+            event_angles[count], event_segments[count], event_types[count] = last, i, 1
+            count += 1
+    order = np.argsort(event_angles[:count])
+
+    heap = np.empty(n, dtype=np.int64)
+    position = np.full(n, -1, dtype=np.int64)
+    size = 0
+    coords = []
+    previous = 0.0
+    k = 0
+    while k < count:
+        angle = event_angles[order[k]]
+        group_end = k
+        while group_end < count and event_angles[order[group_end]] == angle:
+            group_end += 1
+        next_angle = event_angles[order[group_end]] if group_end < count else width
+        nearest = heap[0] if size else -1
+
+        # Закончившиеся отрезки сравниваются между предыдущим и текущим событием,
+        # начавшиеся - между текущим и следующим
+        middle = start_angle + (previous + angle) / 2
+        for e in range(k, group_end):
+            i = event_segments[order[e]]
+            if i >= 0 and event_types[order[e]] == 1 and position[i] >= 0:
+                j = position[i]
+                size -= 1
+                heap_swap(heap, position, j, size)
+                position[i] = -1
+                if j < size:
+                    heap_sift(heap, position, size, j, segments, player_x, player_y,
+                              cos(middle), sin(middle))
+        middle = start_angle + (angle + next_angle) / 2
+        for e in range(k, group_end):
+            i = event_segments[order[e]]
+            if i >= 0 and event_types[order[e]] == 0 and position[i] < 0:
+                heap[size] = i
+                position[i] = size
+                size += 1
+                heap_sift(heap, position, size, size - 1, segments, player_x, player_y,
+                          cos(middle), sin(middle))
+        current = heap[0] if size else -1
+
+        # Вершины полигона: точки на стенах, ближайших до и после события
+        cos_a, sin_a = cos(start_angle + angle), sin(start_angle + angle)
+        changed = nearest != current
+        for segment, emit in ((nearest, angle > 0 and (angle == width or changed)),
+                              (current, angle < width and (angle == 0 or changed))):
+            if segment < 0 or not emit:
+                continue
+            length = segment_distance(segments, segment, player_x, player_y, cos_a, sin_a)
+            res = (int(player_x + length * cos_a), int(player_y + length * sin_a))
+            if not coords or coords[-1] != res:
+                coords.append(res)
+        previous = angle
+        k = group_end
+    return coords
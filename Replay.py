@@ -0,0 +1,96 @@
+import os
+import zlib
+import struct
+import numpy as np
+
+# Файл записи: заголовок HEADER, путь к карте в UTF-8 и сжатые zlib шаги симуляции. Шаги
+# хранятся по столбцам COLUMNS: каждый столбец - разности соседних шагов в zigzag и varint,
+# поэтому неизменный ввод занимает по байту на шаг до сжатия
+MAGIC = b'RPL'
+VERSION = 1
+# Магия, версия, seed, номер уровня, размер экрана, число шагов, курсор до первого шага
+# (в координатах мира), отпечаток состояния после последнего шага, длина пути к карте
+HEADER = struct.Struct('<3sBIHHHIiiIH')
+# flags - нажатые клавиши и кнопки мыши битами, mouse_x и mouse_y - курсор в координатах мира,
+# ai_far - сколько дальних решений принял EnemyAI за шаг
+COLUMNS = ('flags', 'mouse_x', 'mouse_y', 'ai_far')
+
+
+def zigzag(values):
+    # Знаковые числа в беззнаковые: 0, -1, 1, -2, ... -> 0, 1, 2, 3, ...
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def unzigzag(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def encode_varints(values):
+    # Каждое число - по 7 бит на байт от младших к старшим, старший бит байта означает, что
+    # у числа есть следующий байт
+    values = np.asarray(values, dtype=np.uint64)
+    shifts = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    parts = ((values[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        sizes += values >= np.uint64(1 << 7 * k)
+    parts[np.arange(10) < sizes[:, None] - 1] |= 0x80
+    return parts[np.arange(10) < sizes[:, None]].tobytes()
+
+
+def decode_varints(data, count):
+    data = np.frombuffer(data, dtype=np.uint8)
+    last = np.flatnonzero(data < 0x80)  # Последние байты чисел
+    if len(last) != count or (count and last[-1] != len(data) - 1):
+        raise ValueError(f'expected {count} values, found {len(last)}')
+    if not count:
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate(([0], last[:-1] + 1))
+    positions = np.arange(len(data)) - np.repeat(starts, last - starts + 1)
+    parts = (data & 0x7F).astype(np.uint64) << (positions.astype(np.uint64) * np.uint64(7))
+    return np.add.reduceat(parts, starts)
+
+
+def encode_ticks(ticks):
+    # ticks - массив (шаги, COLUMNS) целых чисел
+    deltas = np.diff(np.asarray(ticks, dtype=np.int64).reshape(-1, len(COLUMNS)), axis=0,
+                     prepend=np.zeros((1, len(COLUMNS)), dtype=np.int64))
+    return zlib.compress(encode_varints(zigzag(deltas.T.ravel())), 9)
+
+
+def decode_ticks(data, count):
+    deltas = unzigzag(decode_varints(zlib.decompress(data), count * len(COLUMNS)))
+    return np.cumsum(deltas.reshape(len(COLUMNS), count).T, axis=0)
+
+
+def save_replay(path, replay):
+    # replay - словарь с полями заголовка и шагами ticks, возвращает путь к файлу
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    map_path = replay['map'].encode()
+    with open(path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, replay['seed'], replay['level'],
+                               replay['width'], replay['height'], len(replay['ticks']),
+                               *replay['mouse'], replay['fingerprint'], len(map_path)))
+        file.write(map_path)
+        file.write(encode_ticks(replay['ticks']))
+    return path
+
+
+def load_replay(path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    (magic, version, seed, level, width, height, count, mouse_x, mouse_y, fingerprint,
+     map_size) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a replay of version {VERSION}')
+    start = HEADER.size + map_size
+    return {
+        'seed': seed,
+        'level': level,
+        'width': width,
+        'height': height,
+        'mouse': (mouse_x, mouse_y),
+        'fingerprint': fingerprint,
+        'map': data[HEADER.size:start].decode(),
+        'ticks': decode_ticks(data[start:], count),
+    }
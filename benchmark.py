@@ -0,0 +1,199 @@
+import os
+import json
+import random
+import argparse
+from math import cos, sin
+from time import perf_counter
+
+# Окно и звук не нужны: SDL работает на пустых драйверах, их нужно задать до импорта main.
+# Приветствие pygame тоже убирается, чтобы в stdout был только JSON
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+
+import numpy as np
+import pygame
+import main
+from Kernels import warm_up
+from Replay import load_replay
+from RayCasting import in_view_batch
+
+
+class ScriptedInput(main.PygameInput):
+    # Детерминированный ввод: игрок ходит по кругу (W, D, S, A по 60 кадров), прицел вращается
+    # вокруг центра экрана, стрельба зажата
+    MOVES = (pygame.K_w, pygame.K_d, pygame.K_s, pygame.K_a)
+
+    def __init__(self, radius=300, aim_speed=0.05, move_time=60):
+        self.radius = radius
+        self.aim_speed = aim_speed
+        self.move_time = move_time
+        self.frame = 0
+
+    def end_tick(self):
+        self.frame += 1
+
+    def keys(self):
+        return main.Keys({self.MOVES[self.frame // self.move_time % len(self.MOVES)]})
+
+    def mouse_pos(self):
+        angle = self.frame * self.aim_speed
+        return (int(main.WIDTH // 2 + self.radius * cos(angle)),
+                int(main.HEIGHT // 2 + self.radius * sin(angle)))
+
+    def mouse_pressed(self):
+        return True, False, False
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def run(level_number, frames, seed, warmup=30, immortal=True, profile=False, path=None,
+        ai_budget=None, replay=None, render=True):
+    # Прогоняет кадры go_game по одному шагу симуляции на кадр без ограничения FPS и возвращает
+    # статистику времени кадра
+    # replay - запись игры (Replay.load_replay): ввод, seed и уровень берутся из нее, а кадров
+    # столько же, сколько шагов в записи. render=False - только шаги симуляции, без вывода.
+    # ai_budget - бюджет EnemyAI в миллисекундах, по умолчанию без ограничения, чтобы исход
+    # прогона не зависел от скорости машины
+    random.seed(seed)
+    main.AI.budget_ms = ai_budget
+    if replay is not None:
+        frames = max(len(replay['ticks']) - warmup, 1)
+    main.PROFILER = main.Profiler()
+    main.PROFILER.enabled = profile
+    main.clear_groups()
+    start = perf_counter()
+    if replay is not None:
+        main.start_replay(replay)
+    else:
+        main.INPUT = ScriptedInput()
+        main.init_globals(level_number, path)
+    load_time = perf_counter() - start
+    if immortal and replay is None:
+        main.player.max_hp = main.player.hp = 10 ** 9
+
+    times = []
+    for frame in range(warmup + frames):
+        pygame.event.pump()
+        if frame == warmup:
+            main.PROFILER.reset()
+        start = perf_counter()
+        main.PROFILER.begin()
+        if not (main.player.is_dead or replay is not None and main.INPUT.finished()):
+            main.update_game()
+            if render:
+                main.draw_game()
+        if render:
+            main.present_frame(False)
+        if frame == 0:
+            first_frame = perf_counter() - start
+        if frame >= warmup:
+            times.append(perf_counter() - start)
+
+    total = sum(times)
+    report = {
+        'level': main.LEVEL,
+        'map': main.level.path,
+        'map_size': [main.level.map_w, main.level.map_h],
+        'load_ms': load_time * 1000,
+        'seed': seed,
+        'frames': frames,
+        'fps': frames / total if total else 0,
+        'first_frame_ms': first_frame * 1000,
+        'frame_time_ms': {
+            'mean': total / frames * 1000,
+            'p50': percentile(times, 50) * 1000,
+            'p95': percentile(times, 95) * 1000,
+            'p99': percentile(times, 99) * 1000,
+            'max': max(times) * 1000,
+        },
+        'enemies': len(main.enemies),
+        'particles': len(main.particles),
+        'score': main.level.score,
+        'player_dead': main.player.is_dead,
+        'stages_ms': main.PROFILER.summary(),
+        'stages_max_ms': main.PROFILER.peaks(),
+        'visibility': main.player.visibility.stats(),
+        'ai': main.AI.stats(),
+        'pvs_bytes': main.level.pvs_memory(),
+        'rotations': main.ROTATIONS.stats(),
+        'assets': main.ASSETS.stats(),
+    }
+    if replay is not None:
+        report['replay'] = {'ticks': len(replay['ticks']), 'matches': main.INPUT.matches()}
+    return report
+
+
+def check_pvs(level_number, pairs, seed, path=None):
+    # Сравнивает отсечение по PVS с точной проверкой in_view_grid на случайных парах точек уровня.
+    # Четверть точек ставится на линии сетки, где отрезки касаются стен. PVS не должен отсекать
+    # ни одной пары, которая видит друг друга (false_negatives = 0)
+    main.clear_groups()
+    main.init_globals(level_number, path)
+    level = main.level
+    rng = np.random.default_rng(seed)
+    points = rng.random((pairs, 4)) * ((level.width, level.height) * 2)
+    grid_points = points[:pairs // 4]
+    grid_points[:, ::2] = np.round(grid_points[:, ::2] / level.cell_w) * level.cell_w
+    grid_points[:, 1::2] = np.round(grid_points[:, 1::2] / level.cell_h) * level.cell_h
+    exact = in_view_batch(points, level.grid, np.zeros((0, 0), dtype=np.uint8),
+                          level.cell_w, level.cell_h)
+    with_pvs = in_view_batch(points, level.grid, level.pvs, level.cell_w, level.cell_h)
+    return {
+        'map': level.path,
+        'pvs_built': level.pvs.shape[0] == level.grid.size,
+        'pairs': pairs,
+        'visible': int(exact.sum()),
+        'visible_with_pvs': int(with_pvs.sum()),
+        'false_negatives': int((exact & ~with_pvs).sum()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless benchmark of the game loop')
+    parser.add_argument('--level', type=int, default=1)
+    parser.add_argument('--map', help='map file instead of levels/level_N.txt, '
+                                      'e.g. levels/generated/huge.txt (see LevelGenerator)')
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warmup', type=int, default=30,
+                        help='frames excluded from the statistics (JIT compilation)')
+    parser.add_argument('--mortal', action='store_true', help='let enemies kill the player')
+    parser.add_argument('--profile', action='store_true',
+                        help='add the mean and max time of every frame stage to the report')
+    parser.add_argument('--warm-up', action='store_true',
+                        help='compile the numba kernels before the run and report the time')
+    parser.add_argument('--ai-budget', type=float, default=0,
+                        help=f'AI milliseconds per frame (the game uses {main.AI_BUDGET_MS}), '
+                             'default 0 for no limit; with a limit the outcome depends on the '
+                             'machine speed')
+    parser.add_argument('--replay', help='play a recorded game (F5 in game) instead of the '
+                                         'scripted input; --level, --map and --frames are '
+                                         'taken from the recording')
+    parser.add_argument('--no-render', action='store_true',
+                        help='run only the simulation steps, without drawing frames')
+    parser.add_argument('--check-pvs', type=int, metavar='PAIRS',
+                        help='instead of the benchmark, check that the PVS of the level never '
+                             'hides a visible pair of random points; exits with 1 if it does')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.check_pvs:
+        result = check_pvs(args.level, args.check_pvs, args.seed, args.map)
+        print(json.dumps(result, indent=2))
+        raise SystemExit(1 if result['false_negatives'] else 0)
+
+    kernels = warm_up() if args.warm_up else {}
+    report = run(args.level, args.frames, args.seed, args.warmup, not args.mortal, args.profile,
+                 args.map, args.ai_budget or None,
+                 load_replay(args.replay) if args.replay else None, not args.no_render)
+    report['kernels_s'] = sum(kernels.values())
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
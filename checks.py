@@ -0,0 +1,237 @@
+import os
+import json
+import argparse
+import tempfile
+from functools import partial
+
+# Проверки точных ускорений: быстрый вариант сравнивается с простым на случайных данных.
+# SDL работает на пустых драйверах, как в benchmark.py
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+
+import numpy as np
+import main
+from RayCasting import ray_fan_cycle, ray_fan_dda, visibility_polygon
+from Collisions import segment_rect, sweep_bullets
+from Replay import encode_ticks, decode_ticks, save_replay, load_replay, COLUMNS
+
+LEVELS = range(1, 6)
+FOV = 100  # Половина веера лучей игрока в сотых долях радиана
+
+
+def random_poses(level, rng, count):
+    # Случайные точки внутри свободных клеток уровня и углы первого луча веера
+    free = np.argwhere(~level.grid)
+    cells = free[rng.integers(len(free), size=count)]
+    x = cells[:, 1] * level.cell_w + rng.integers(1, level.cell_w, size=count)
+    y = cells[:, 0] * level.cell_h + rng.integers(1, level.cell_h, size=count)
+    first = rng.integers(-314, 315, size=count) - FOV
+    return zip(x.tolist(), y.tolist(), first.tolist())
+
+
+def polyline_distance(points, polyline):
+    # Расстояние от каждой точки до ближайшего звена ломаной
+    a, b = polyline[:-1], polyline[1:]
+    ab = b - a
+    ap = points[:, None] - a
+    t = np.clip((ap * ab).sum(2) / np.maximum((ab * ab).sum(1), 1e-9), 0, 1)
+    return np.hypot(*(ap - t[..., None] * ab).transpose(2, 0, 1)).min(1)
+
+
+def check_rays(poses, seed):
+    # Лучи ray_fan_dda должны совпадать с лучами перебора стенок ray_fan_cycle, а концы лучей
+    # лежать на границе точного полигона visibility_polygon (с точностью до округления)
+    rng = np.random.default_rng(seed)
+    count = 2 * FOV + 1
+    dda = np.empty((count, 2), dtype=np.int32)
+    cycle = np.empty((count, 2), dtype=np.int32)
+    rays = mismatches = off_polygon = 0
+    worst = 0.0
+    for number in LEVELS:
+        main.clear_groups()
+        main.init_globals(number)
+        level = main.level
+        for x, y, first in random_poses(level, rng, poses):
+            ray_fan_dda(x, y, first, count, level.grid, level.cell_w, level.cell_h, dda, 0)
+            ray_fan_cycle(x, y, first, count, level.ray_obstacles, level.cell_w, level.cell_h,
+                          level.map_w, level.map_h, cycle, 0)
+            hits = visibility_polygon(x, y, (first + FOV) / 100, level.segments, FOV)
+            polygon = np.array(hits, dtype=np.float64).reshape(-1, 2)
+            distance = polyline_distance(dda.astype(np.float64), polygon)
+            rays += count
+            mismatches += int((dda != cycle).any(1).sum())
+            off_polygon += int((distance > 2).sum())
+            worst = max(worst, float(distance.max()))
+    return {
+        'check': 'rays',
+        'rays': rays,
+        'dda_vs_cycle_mismatches': mismatches,
+        'off_polygon': off_polygon,
+        'max_polygon_distance': round(worst, 3),
+        'passed': not mismatches and not off_polygon,
+    }
+
+
+def check_visibility(frames, seed):
+    # Лучи из VisibilityCache (из кэша, с досчитанным краем веера или полностью пересчитанные)
+    # должны совпадать с веером, посчитанным заново из той же точки. Игрок ходит случайно
+    # с шагом до Player.v, часто стоит на месте и поворачивается на случайный угол
+    rng = np.random.default_rng(seed)
+    count = 2 * FOV + 1
+    fresh = np.empty((count, 2), dtype=np.int32)
+    mismatches = 0
+    stats = {'hits': 0, 'partial': 0, 'misses': 0}
+    for number in LEVELS:
+        main.clear_groups()
+        main.init_globals(number)
+        level, player = main.level, main.player
+        cache = main.VisibilityCache(FOV)
+        x, y, first = next(random_poses(level, rng, 1))
+        for _ in range(frames):
+            player.ray_engine = 'dda' if rng.random() < 0.9 else 'cycle'
+            if rng.random() < 0.5:
+                angle, step = rng.uniform(-np.pi, np.pi), rng.uniform(0, player.v)
+                new_x, new_y = int(x + step * np.cos(angle)), int(y + step * np.sin(angle))
+                if not level.grid[new_y // level.cell_h, new_x // level.cell_w]:
+                    x, y = new_x, new_y
+            first += int(rng.choice((0, 0, 1, -1, 5, -5, 150, -300)))
+            first = (first + 314 + FOV) % 629 - 314 - FOV
+            ray_x = round(x / main.VISIBILITY_STEP) * main.VISIBILITY_STEP
+            ray_y = round(y / main.VISIBILITY_STEP) * main.VISIBILITY_STEP
+            points = cache.get((ray_x, ray_y, player.ray_engine, level.version), first,
+                               partial(player.cast_rays, ray_x, ray_y))
+            player.cast_rays(ray_x, ray_y, fresh, 0, first, count)
+            mismatches += int((points != fresh).any(1).sum())
+        for key in stats:
+            stats[key] += cache.stats()[key]
+    return {
+        'check': 'visibility',
+        'frames': frames * len(LEVELS),
+        **stats,
+        'mismatched_rays': mismatches,
+        'passed': not mismatches,
+    }
+
+
+def random_scene(rng, map_w, map_h, tile):
+    # Враги со случайными ректами в целых пикселях, как у EnemyPool.rects(), и здоровьем, и пули:
+    # половина летит из случайных точек, половина - залпом из одной точки, чтобы враги умирали
+    # посреди залпа
+    enemies, bullets = rng.integers(1, 60), rng.integers(1, 40)
+    size = rng.integers(20, 70, (enemies, 2))
+    rects = np.column_stack((rng.integers(0, map_w * tile - size[:, 0]),
+                             rng.integers(0, map_h * tile - size[:, 1]), size)).astype(np.float64)
+    hp = rng.integers(1, 4, enemies).astype(np.float64)
+    x0 = rng.uniform(0, map_w * tile, bullets)
+    y0 = rng.uniform(0, map_h * tile, bullets)
+    volley = rng.random(bullets) < 0.5
+    x0[volley], y0[volley] = x0[0], y0[0]
+    angle = rng.uniform(-np.pi, np.pi, bullets)
+    length = rng.uniform(0, 80, bullets)
+    x1 = np.clip(x0 + length * np.cos(angle), 0, map_w * tile - 1)
+    y1 = np.clip(y0 + length * np.sin(angle), 0, map_h * tile - 1)
+    return x0, y0, x1, y1, np.ones(bullets), rects, hp
+
+
+def check_sweep(scenes, seed):
+    # sweep_bullets должен попадать так же, как перебор всех живых врагов: пуля попадает
+    # во врага с самым ранним входом на отрезке. Если несколько врагов задеты в одной точке
+    # (пуля вылетела изнутри пересекающихся ректов), подходит любой из них
+    rng = np.random.default_rng(seed)
+    map_w, map_h, tile = 30, 20, 32
+    bullets = mismatches = hits = 0
+    for _ in range(scenes):
+        x0, y0, x1, y1, dmg, rects, hp = random_scene(rng, map_w, map_h, tile)
+        expected_hp = hp.copy()
+        targets = np.empty(len(x0), dtype=np.int64)
+        sweep_bullets(x0, y0, x1, y1, dmg, rects, hp, tile, tile, map_w, targets)
+        for b, target in enumerate(targets.tolist()):
+            times = np.array([segment_rect(x0[b], y0[b], x1[b], y1[b], *rect) for rect in rects])
+            times[(times < 0) | (expected_hp <= 0)] = np.inf
+            earliest = times.min()
+            if target < 0:
+                mismatches += int(earliest < np.inf)
+            elif times[target] != earliest:
+                mismatches += 1
+            else:
+                expected_hp[target] -= dmg[b]
+                hits += 1
+        bullets += len(x0)
+        mismatches += int((hp != expected_hp).any())
+    return {
+        'check': 'sweep',
+        'scenes': scenes,
+        'bullets': bullets,
+        'hits': hits,
+        'mismatches': mismatches,
+        'passed': not mismatches,
+    }
+
+
+def random_ticks(rng, count):
+    # Шаги записи: как в игре (маленькие разности соседних шагов) и крайние значения до ±2^62,
+    # разности которых выходят за int64
+    ticks = np.cumsum(rng.integers(-3, 4, (count, len(COLUMNS))), axis=0)
+    extreme = rng.random((count, len(COLUMNS))) < 0.05
+    ticks[extreme] = rng.choice([-2 ** 62, 2 ** 62, -2 ** 62 + 1, 2 ** 62 - 1], extreme.sum())
+    return ticks
+
+
+def check_replay(replays, seed):
+    # Шаги записи должны восстанавливаться без потерь: и через encode_ticks/decode_ticks,
+    # и через файл save_replay/load_replay вместе с заголовком
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+    ticks_total = 0
+    with tempfile.TemporaryDirectory() as folder:
+        for number in range(replays):
+            count = int(rng.integers(0, 5000)) if number else 0
+            ticks = random_ticks(rng, count)
+            mismatches += int(not np.array_equal(decode_ticks(encode_ticks(ticks), count), ticks))
+            replay = {'seed': int(rng.integers(2 ** 32)), 'level': number % 5 + 1,
+                      'width': 1280, 'height': 720, 'mouse': (-5, 7),
+                      'fingerprint': int(rng.integers(2 ** 32)), 'map': 'levels/карта.txt',
+                      'ticks': ticks}
+            loaded = load_replay(save_replay(os.path.join(folder, f'{number}.rpl'), replay))
+            mismatches += int(any(not np.array_equal(loaded[key], value)
+                                  for key, value in replay.items()))
+            ticks_total += count
+    return {
+        'check': 'replay',
+        'replays': replays,
+        'ticks': ticks_total,
+        'mismatches': mismatches,
+        'passed': not mismatches,
+    }
+
+
+CHECKS = {
+    'rays': lambda args: check_rays(args.poses, args.seed),
+    'visibility': lambda args: check_visibility(args.frames, args.seed),
+    'sweep': lambda args: check_sweep(args.scenes, args.seed),
+    'replay': lambda args: check_replay(args.replays, args.seed),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the fast kernels against simple ones')
+    parser.add_argument('checks', nargs='*', metavar='CHECK',
+                        help=f'checks to run: {", ".join(CHECKS)}; all by default')
+    parser.add_argument('--poses', type=int, default=200,
+                        help='random player poses per level for the ray checks')
+    parser.add_argument('--frames', type=int, default=2000,
+                        help='frames per level for the visibility cache check')
+    parser.add_argument('--scenes', type=int, default=200,
+                        help='random scenes of enemies and bullets for the sweep check')
+    parser.add_argument('--replays', type=int, default=50,
+                        help='random recordings for the replay round-trip check')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f'unknown checks: {", ".join(sorted(unknown))}')
+
+    results = [CHECKS[name](args) for name in args.checks or CHECKS]
+    print(json.dumps(results, indent=2))
+    raise SystemExit(0 if all(result['passed'] for result in results) else 1)
@@ -1,179 +1,595 @@
 import pygame
+import numpy as np
 import os
+import csv
+import json
+import hashlib
+import zlib
 import sys
-from PIL import Image
+import argparse
+from numba import get_num_threads
 from numba.typed import List
 from math import cos, sin, atan2, pi, degrees, ceil
-from collections import deque
-from random import randint, choice, random
-from RayCasting import ray_cycle, in_view
+from collections import OrderedDict
+from functools import partial
+from threading import Thread, RLock
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, strftime
+from random import randint, choice, random, seed as random_seed
+from RayCasting import (ray_fan_cycle, ray_fan_dda, collapse_vertices, screen_frame,
+                        visibility_polygon, in_view_grid, in_view_batch, build_pvs,
+                        FRAME_VERTICES)
+from PathFinding import flow_field, think_enemies
+from Particles import update_particles
+from Collisions import move_enemies, sweep_bullets
+from Kernels import warm_up
+from LevelCompiler import load_level
+from Replay import save_replay, load_replay, COLUMNS as REPLAY_COLUMNS
+
+# Замеры холодного старта: момент загрузки модуля, время компиляции ядер numba и время
+# от загрузки до первого кадра игры
+STARTUP = {'start': perf_counter(), 'kernels': {}, 'first_frame': None}
 
 pygame.init()
 display_info = pygame.display.Info()
 size = WIDTH, HEIGHT = display_info.current_w, display_info.current_h
 SCREEN = pygame.display.set_mode(size, flags=pygame.FULLSCREEN)
 
+# Частота шагов симуляции: скорости и таймеры игры заданы на один шаг длиной TICK секунд
 FPS = 60
+TICK = 1 / FPS
+# Кадры выводятся не чаще RENDER_FPS, положения объектов между шагами интерполируются. Если кадр
+# затянулся, симуляция догоняет время, но не больше чем на MAX_TICKS шагов за кадр
+RENDER_FPS = 60
+MAX_TICKS = 5
 CLOCK = pygame.time.Clock()
 
 ENEMY_TYPES = [(70, 15, 4), (100, 10, 3), (250, 10, 2)]
+# Сторона квадратного ректа столкновений игрока и врагов
+COLLISION_SIZE = 25
+
+# Движок рейкаста: 'cycle' - перебор стенок в ray_fan_cycle, 'dda' - обход сетки в ray_fan_dda,
+# 'polygon' - точный полигон видимости по концам отрезков стен в visibility_polygon
+RAY_ENGINE = 'dda'
+# PVS занимает (клеток ** 2) / 8 байт, поэтому для больших карт он не строится
+PVS_MAX_CELLS = 4096
+# Минимальный размер клетки в пикселях: карта, которая не помещается на экран с такими клетками,
+# прокручивается за игроком. Загружены только чанки уровня, которые видны на экране или лежат
+# не дальше STREAM_MARGIN чанков от него
+CELL_SIZE = 32
+STREAM_MARGIN = 1
+# Лучи области видимости считаются из положения игрока, округленного до VISIBILITY_STEP пикселей,
+# чтобы кэш лучей не промахивался из-за дробного сдвига при интерполяции кадра
+VISIBILITY_STEP = 4
+# Шаг поворота спрайтов в градусах и предельный размер кэша повернутых спрайтов в байтах
+ROTATION_STEP = 2
+ROTATION_CACHE_SIZE = 16 * 1024 * 1024
+# Папка для кэша собранного пола на диске (вне папки с ресурсами), None - только в памяти
+FLOOR_CACHE_DIR = None
+# Доля экрана, при превышении которой вместо вывода изменившихся областей обновляется весь экран
+FULL_FLIP_RATIO = 0.5
+# Сколько последних кадров хранит профилировщик, и папка для выгрузки замеров
+PROFILER_FRAMES = 300
+PROFILER_DIR = 'profiles'
+# Число потоков для решений врагов и минимальное число врагов на один поток: на малом
+# количестве врагов запуск потоков дороже самих расчетов
+AI_WORKERS = os.cpu_count() or 1
+AI_SHARD = 32
+# Планировщик решений врагов: враги на экране (с запасом AI_NEAR_MARGIN пикселей) и видящие
+# игрока решают каждый кадр, остальные - раз в AI_FAR_PERIOD кадров по очереди. Дальние решения
+# откладываются на следующие кадры, если AI за кадр тратит больше AI_BUDGET_MS миллисекунд
+AI_NEAR_MARGIN = 64
+AI_FAR_PERIOD = 4
+AI_BUDGET_MS = 2.0
+# Папка для записей ввода (F5 сохраняет запись текущей игры) и клавиши, которые попадают в запись
+REPLAY_DIR = 'replays'
+REPLAY_KEYS = (pygame.K_w, pygame.K_a, pygame.K_s, pygame.K_d)
+
+# Звук выстрела и наведения на кнопку: (файл, громкость)
+SHOT_SOUND = ('sounds/hover_over_the_button.mp3', 0.05)
+HOVER_SOUND = ('sounds/hover_over_the_button.mp3', 0.1)
+# Ресурсы, которые загружаются в фоне при запуске игры, пока открыто меню. Фон меню нужен сразу,
+# поэтому он загружается в start_menu
+PRELOAD_IMAGES = ('data/player.png',) + tuple(f'data/floor{i}.png' for i in range(1, 7))
+PRELOAD_SOUNDS = (SHOT_SOUND, HOVER_SOUND)
+
+
+class Assets:
+    # Реестр ресурсов: каждое изображение, звук и шрифт загружается с диска один раз, дальше
+    # все используют общий экземпляр
+    def __init__(self):
+        self.images = {}  # (путь, colorkey) -> изображение
+        self.sounds = {}  # (путь, громкость) -> звук
+        self.fonts = {}  # (шрифт, размер) -> шрифт
+        self.load_times = {}  # ключ ресурса -> время загрузки в секундах
+        # Путь -> изображение, прочитанное фоновым потоком. Поверхности конвертируются только
+        # в главном потоке: convert() и convert_alpha() в SDL не потокобезопасны
+        self.decoded = {}
+        self.lock = RLock()
+        self.thread = None
+
+    def decode(self, path):
+        # Читает изображение с диска без конвертации в формат экрана
+        if not os.path.isfile(path):
+            print(f"Файл с изображением '{path}' не найден")
+            sys.exit()
+        return pygame.image.load(path)
+
+    def convert(self, image, colorkey=None):
+        if colorkey is not None:
+            image = image.convert()
+            if colorkey == -1:
+                colorkey = image.get_at((0, 0))
+            image.set_colorkey(colorkey)
+        else:
+            image = image.convert_alpha()
+        return image
+
+    def image(self, path, colorkey=None):
+        # Изображение, прочитанное заранее в фоне, только конвертируется
+        key = path, colorkey
+        with self.lock:
+            if key not in self.images:
+                start = perf_counter()
+                image = self.decoded.pop(path, None)
+                if image is None:
+                    image = self.decode(path)
+                self.images[key] = self.convert(image, colorkey)
+                self.load_times[key] = self.load_times.pop(path, 0) + perf_counter() - start
+            return self.images[key]
+
+    def sound(self, path, volume=1.0):
+        key = path, volume
+        with self.lock:
+            if key not in self.sounds:
+                start = perf_counter()
+                sound = pygame.mixer.Sound(path)
+                sound.set_volume(volume)
+                self.sounds[key] = sound
+                self.load_times[key] = perf_counter() - start
+            return self.sounds[key]
+
+    def font(self, name=None, size=32):
+        key = name, size
+        with self.lock:
+            if key not in self.fonts:
+                start = perf_counter()
+                self.fonts[key] = pygame.font.Font(name, size)
+                self.load_times[key] = perf_counter() - start
+            return self.fonts[key]
+
+    def preload(self, images=PRELOAD_IMAGES, sounds=PRELOAD_SOUNDS):
+        # Загружает ресурсы в фоновом потоке, пока открыто меню. Изображения в потоке только
+        # читаются с диска, конвертирует их image() при первом использовании
+        def load_all():
+            for path in images:
+                start = perf_counter()
+                image = self.decode(path)
+                with self.lock:
+                    if not any(key[0] == path for key in self.images):
+                        self.decoded[path] = image
+                        self.load_times[path] = perf_counter() - start
+            for path, volume in sounds:
+                self.sound(path, volume)
+
+        self.thread = Thread(target=load_all, daemon=True)
+        self.thread.start()
+
+    def memory(self):
+        # Примерный объем памяти, занятой ресурсами, в байтах
+        size = sum(image.get_bytesize() * image.get_width() * image.get_height()
+                   for image in self.images.values())
+        mixer = pygame.mixer.get_init()
+        if mixer:
+            frequency, bits, channels = mixer
+            size += sum(int(sound.get_length() * frequency) * channels * abs(bits) // 8
+                        for sound in self.sounds.values())
+        return size
+
+    def stats(self):
+        return {'images': len(self.images), 'sounds': len(self.sounds),
+                'fonts': len(self.fonts), 'bytes': self.memory(),
+                'load_time': sum(self.load_times.values())}
+
+
+ASSETS = Assets()
+
+
+class PygameInput:
+    # Источник ввода игрока. Для бенчмарка и повтора записи подменяется на другой объект
+    # с теми же методами
+    def keys(self):
+        return pygame.key.get_pressed()
+
+    def mouse_pos(self):
+        return pygame.mouse.get_pos()
+
+    def mouse_pressed(self):
+        return pygame.mouse.get_pressed()
+
+    def begin_tick(self):
+        # Вызывается перед каждым шагом симуляции, а end_tick - после него
+        pass
+
+    def end_tick(self):
+        pass
+
+
+class Keys:
+    # Замена pygame.key.get_pressed() для заданного набора нажатых клавиш
+    def __init__(self, pressed):
+        self.pressed = pressed
+
+    def __getitem__(self, key):
+        return key in self.pressed
+
+
+def tick_seed(seed, tick):
+    # Seed генератора random на шаге tick записи: шаги не зависят от того, сколько случайных
+    # чисел взяли предыдущие
+    return seed << 32 | tick
+
+
+class ReplayRecorder(PygameInput):
+    # Записывает ввод из source на каждом шаге симуляции: клавиши REPLAY_KEYS и кнопки мыши
+    # битами, курсор в координатах мира (запись не зависит от положения камеры при выводе)
+    # и число дальних решений EnemyAI, которое зависит от времени кадра. Перед шагом генератор
+    # random получает seed из tick_seed. Весь шаг игра видит ввод, прочитанный в его начале
+    def __init__(self, source, seed):
+        self.source = source
+        self.seed = seed
+        self.level, self.map = LEVEL, level.path
+        self.mouse = camera.to_world(*source.mouse_pos())  # Курсор до первого шага
+        self.pressed, self.position, self.buttons = Keys(set()), source.mouse_pos(), (False,) * 3
+        self.ticks = np.zeros((FPS * 60, len(REPLAY_COLUMNS)), dtype=np.int64)
+        self.count = 0  # Записано шагов
+
+    def keys(self):
+        return self.pressed
+
+    def mouse_pos(self):
+        return self.position
+
+    def mouse_pressed(self):
+        return self.buttons
+
+    def begin_tick(self):
+        random_seed(tick_seed(self.seed, self.count))
+        self.source.begin_tick()
+        keys = self.source.keys()
+        self.pressed = Keys({key for key in REPLAY_KEYS if keys[key]})
+        self.position = self.source.mouse_pos()
+        self.buttons = tuple(bool(button) for button in self.source.mouse_pressed()[:3])
+        flags = sum(1 << i for i, key in enumerate(REPLAY_KEYS) if keys[key])
+        flags |= sum(1 << len(REPLAY_KEYS) + i for i, button in enumerate(self.buttons) if button)
+        if self.count == len(self.ticks):
+            self.ticks = np.concatenate((self.ticks, np.zeros_like(self.ticks)))
+        self.ticks[self.count, :3] = (flags,) + camera.to_world(*self.position)
+
+    def end_tick(self):
+        self.source.end_tick()
+        self.ticks[self.count, 3] = AI.last[1]
+        self.count += 1
+
+    def save(self):
+        # Сохраняет запись с начала игры в REPLAY_DIR, возвращает путь к файлу
+        path = os.path.join(REPLAY_DIR, f'replay_{strftime("%Y%m%d_%H%M%S")}.rpl')
+        return save_replay(path, {'seed': self.seed, 'level': self.level, 'width': WIDTH,
+                                  'height': HEIGHT, 'mouse': self.mouse,
+                                  'fingerprint': state_fingerprint(), 'map': self.map,
+                                  'ticks': self.ticks[:self.count]})
+
+
+class ReplayInput(PygameInput):
+    # Ввод из записи: на каждом шаге возвращает записанные клавиши и кнопки, курсор переводится
+    # из координат мира в координаты текущей камеры. Перед шагом задает seed генератору random
+    # и число дальних решений EnemyAI, как при записи
+    def __init__(self, replay):
+        self.replay = replay
+        self.tick = 0
+        self.pressed, self.buttons, self.mouse = Keys(set()), (False,) * 3, replay['mouse']
+
+    def finished(self):
+        return self.tick >= len(self.replay['ticks'])
 
-ENEMY_IMAGE = pygame.image.load('data/enemy.png').convert_alpha()
-BLOOD_IMAGE = pygame.image.load('data/bullet.png').convert_alpha()
-HEAL_IMAGE = pygame.image.load('data/heal.png').convert_alpha()
-DROP_BULLET_IMAGE = pygame.image.load('data/drop_bullet.png').convert_alpha()
+    def matches(self):
+        # Совпало ли состояние после всех шагов с состоянием при записи
+        return self.finished() and state_fingerprint() == self.replay['fingerprint']
+
+    def keys(self):
+        return self.pressed
+
+    def mouse_pos(self):
+        return camera.to_screen(*self.mouse)
+
+    def mouse_pressed(self):
+        return self.buttons
+
+    def begin_tick(self):
+        flags, x, y, ai_far = self.replay['ticks'][self.tick].tolist()
+        random_seed(tick_seed(self.replay['seed'], self.tick))
+        self.pressed = Keys({key for i, key in enumerate(REPLAY_KEYS) if flags >> i & 1})
+        self.buttons = tuple(bool(flags >> len(REPLAY_KEYS) + i & 1) for i in range(3))
+        self.mouse = x, y
+        AI.quota = ai_far
+
+    def end_tick(self):
+        AI.quota = None
+        self.tick += 1
+
+
+INPUT = PygameInput()
+
+ENEMY_IMAGE = ASSETS.image('data/enemy.png')
+BLOOD_IMAGE = ASSETS.image('data/bullet.png')
+HEAL_IMAGE = ASSETS.image('data/heal.png')
+DROP_BULLET_IMAGE = ASSETS.image('data/drop_bullet.png')
 
 all_sprites = pygame.sprite.Group()
 walls_group = pygame.sprite.Group()
-enemies_group = pygame.sprite.Group()
-bouncing_obj_group = pygame.sprite.Group()
 spawn_points_group = pygame.sprite.Group()
 drops_group = pygame.sprite.Group()
 
 
-class Level:
-    def __init__(self):
-        self.map = self.create_level()
-        self.distances = None
+class RotationCache:
+    # Кэш повернутых спрайтов: угол округляется до шага ROTATION_STEP, и каждый поворот
+    # считается один раз. Если кэш превышает предельный размер, удаляются давно не
+    # использованные повороты
+    def __init__(self, step=ROTATION_STEP, max_size=ROTATION_CACHE_SIZE):
+        self.step = step
+        self.max_size = max_size
+        self.images = OrderedDict()  # (спрайт, номер шага) -> повернутый спрайт
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image, angle):
+        # Возвращает спрайт, повернутый на angle градусов с точностью до шага
+        key = image, round(angle / self.step) % round(360 / self.step)
+        rotated = self.images.get(key)
+        if rotated is not None:
+            self.hits += 1
+            self.images.move_to_end(key)
+            return rotated
+        self.misses += 1
+        rotated = pygame.transform.rotate(image, key[1] * self.step)
+        self.images[key] = rotated
+        self.size += self.surface_size(rotated)
+        while self.size > self.max_size and len(self.images) > 1:
+            self.size -= self.surface_size(self.images.popitem(last=False)[1])
+        return rotated
+
+    def preload(self, image):
+        # Заранее поворачивает спрайт на все углы
+        for i in range(round(360 / self.step)):
+            self.get(image, i * self.step)
+
+    def surface_size(self, surface):
+        return surface.get_bytesize() * surface.get_width() * surface.get_height()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'images': len(self.images),
+                'bytes': self.size}
+
+
+ROTATIONS = RotationCache()
+ROTATIONS.preload(ENEMY_IMAGE)
+ROTATIONS.preload(BLOOD_IMAGE)
+
+
+class VisibilityCache:
+    # Кэш лучей области видимости между кадрами. Углы лучей кратны шагу веера (1 / 100), а точки
+    # пересечения хранятся в координатах мира, поэтому при сдвиге камеры лучи только переносятся
+    # на экране. Пока игрок стоит на месте, лучи берутся из кэша, а при повороте считаются только
+    # лучи, которые вошли в веер с края. Весь веер пересчитывается, если игрок сдвинулся на другую
+    # точку сетки VISIBILITY_STEP или изменились стены. Маска тени не кэшируется: вывод готовой
+    # маски размером с экран дольше, чем заливка многоугольника
+    def __init__(self, fov):
+        self.points = np.empty((2 * fov + 1, 2), dtype=np.int32)
+        self.key = None  # Положение игрока с шагом VISIBILITY_STEP, движок и версия стен
+        self.first = 0  # Номер угла первого луча
+        self.hits = 0  # Кадры без новых лучей
+        self.partial = 0  # Кадры, в которые досчитан край веера
+        self.misses = 0
+        self.rays_cast = 0
+        self.rays_reused = 0
+        self.cast_time = 0  # Время расчета лучей в секундах
+
+    def get(self, key, first, cast):
+        # Возвращает точки лучей с номерами углов [first, first + len(points)). cast(out, start,
+        # first, count) считает count лучей в строки out начиная со start
+        count = len(self.points)
+        shift = first - self.first
+        start = perf_counter()
+        if key != self.key or abs(shift) >= count:
+            cast(self.points, 0, first, count)
+            self.misses += 1
+            cast_rays = count
+        elif shift > 0:
+            self.points[:count - shift] = self.points[shift:]
+            cast(self.points, count - shift, first + count - shift, shift)
+            self.partial += 1
+            cast_rays = shift
+        elif shift < 0:
+            self.points[-shift:] = self.points[:count + shift]
+            cast(self.points, 0, first, -shift)
+            self.partial += 1
+            cast_rays = -shift
+        else:
+            self.hits += 1
+            cast_rays = 0
+        if cast_rays:
+            self.cast_time += perf_counter() - start
+            self.rays_cast += cast_rays
+        self.rays_reused += count - cast_rays
+        self.key, self.first = key, first
+        return self.points
+
+    def stats(self):
+        # Доля кадров без полного пересчета и оценка сэкономленного времени по среднему
+        # времени одного луча
+        frames = self.hits + self.partial + self.misses
+        ray_time = self.cast_time / self.rays_cast if self.rays_cast else 0
+        return {'hits': self.hits, 'partial': self.partial, 'misses': self.misses,
+                'hit_rate': (self.hits + self.partial) / frames if frames else 0,
+                'rays_cast': self.rays_cast, 'rays_reused': self.rays_reused,
+                'cast_ms': self.cast_time * 1000,
+                'saved_ms': self.rays_reused * ray_time * 1000}
 
-        self.map_w = len(self.map[0])
-        self.map_h = len(self.map)
-        self.cell_w = WIDTH // self.map_w
-        self.cell_h = HEIGHT // self.map_h
+
+class Level:
+    def __init__(self, path):
+        # Сетка занятости (True - клетка со стеной), прямоугольники стен, клетки спавна и игрока
+        # и контур стен берутся из собранного уровня (модуль LevelCompiler)
+        self.path = path
+        self.bundle = load_level(path)
+        self.grid = self.bundle['grid']
+        self.map_h, self.map_w = self.grid.shape
+        # Матрица расстояний до игрока и поле направлений к нему в окне загруженных чанков
+        # (враги есть только в них). Пересчитываются только при смене клетки игрока или окна
+        self.distances = np.empty((0, 0), dtype=np.int32)
+        self.directions = np.empty((0, 0, 2), dtype=np.int32)
+        self.flow_window = (0, 0, 0, 0)  # Клетки окна: col0, row0, col1, row1 (не включая)
+        self.player_cell = None
+        self.cell_w = max(WIDTH // self.map_w, CELL_SIZE)
+        self.cell_h = max(HEIGHT // self.map_h, CELL_SIZE)
+        self.width, self.height = self.map_w * self.cell_w, self.map_h * self.cell_h
 
         self.difficulty_coeff = 1
         self.difficulty_changed = False
-        rects = self.merge_rects(self.get_horizontal_rects(), self.get_vertical_rects())
-        self.create_walls(rects)
+        self.segments = self.bundle['segments'] * (self.cell_w, self.cell_h,
+                                                   self.cell_w, self.cell_h)
+        self.pvs = self.create_pvs()
+
+        # Чанки: прямоугольники стен и точки спавна по чанкам. Стенки и препятствия есть только
+        # у загруженных чанков, враги из выгруженных чанков хранятся кортежами в self.dormant
+        self.chunk_size = int(self.bundle['chunk_size'])
+        self.obstacles = SpatialHash(self.cell_w, self.cell_h)  # Все преграды
+        self.chunk_rects = {}
+        for col, row, w, h in self.bundle['rects'].tolist():
+            self.chunk_rects.setdefault(self.get_chunk(col, row), []).append(
+                pygame.Rect(col * self.cell_w, row * self.cell_h, w * self.cell_w, h * self.cell_h))
+        self.chunk_spawns = {}
         self.create_spawn_points()
+        self.chunk_walls = {}  # Загруженный чанк -> стенки
+        self.loaded = np.zeros((ceil(self.map_h / self.chunk_size),
+                                ceil(self.map_w / self.chunk_size)), dtype=np.bool_)
+        self.dormant = {}  # Выгруженный чанк -> [(x, y, тип, hp), ...]
+        self.ray_obstacles = None
+        self.version = 0  # Меняется при загрузке и выгрузке чанков
+        self.update_chunks(*self.player_location())
 
         self.score = 0
 
+    def cell_center(self, col, row):
+        return col * self.cell_w + self.cell_w // 2, row * self.cell_h + self.cell_h // 2
+
     def player_location(self):
         # Возвращает положение игрока на карте
-        for row in range(self.map_h):
-            for col in range(self.map_w):
-                if self.map[row][col] == '@':
-                    self.map[row].replace('@', ' ')
-                    return (col * self.cell_w + self.cell_w // 2,
-                            row * self.cell_h + self.cell_h // 2)
+        for col, row in self.bundle['player'].tolist():
+            return self.cell_center(col, row)
 
     def create_spawn_points(self):
         # Создает точки спавна мобов на карте
-        for row in range(self.map_h):
-            for col in range(self.map_w):
-                if self.map[row][col] == 'E':
-                    self.map[row].replace('E', ' ')
-                    SpawnPoint(col * self.cell_w + self.cell_w // 2,
-                               row * self.cell_h + self.cell_h // 2)
-
-    def create_level(self):
-        # Создает карту уровня
-        with open(f'levels/level_{LEVEL}.txt') as file:
-            map = file.readlines()
-            return [row.rstrip() for row in map]
-
-    def create_walls(self, rects):
-        for rect in rects:
-            Wall(rect.x, rect.y, rect.w, rect.h)
-
-    def merge_rects(self, horizontal, vertical):
-        rects = []
-        for h_rect in horizontal:
-            container = []
-            for v_rect in vertical:
-                if h_rect.contains(v_rect):
-                    container.append(v_rect)
-                    vertical.remove(v_rect)
-            if container:
-                rect = h_rect.unionall(container)
-                rects.append(rect)
-        for v_rect in vertical:
-            container = []
-            for h_rect in horizontal:
-                if v_rect.contains(h_rect):
-                    container.append(h_rect)
-                    horizontal.remove(h_rect)
-            if container:
-                rect = v_rect.unionall(container)
-                rects.append(rect)
-
-        return rects
-
-    def get_horizontal_rects(self):
-        rects = []
-        for row in range(self.map_h):
-            row_rects = []
-            is_rect = False
-            for col in range(self.map_w):
-                if self.map[row][col] == '#':
-                    if not is_rect:
-                        row_rects.append([])
-                        is_rect = True
-                    row_rects[-1].append(col)
-                else:
-                    is_rect = False
-            for i in range(len(row_rects)):
-                col, w = row_rects[i][0], len(row_rects[i])
-                row_rects[i] = pygame.Rect(col * self.cell_w, row * self.cell_h,
-                                           w * self.cell_w, self.cell_h)
-            rects.extend(row_rects)
-        return rects
-
-    def get_vertical_rects(self):
-        rects = []
-        for col in range(self.map_w):
-            col_rects = []
-            is_rect = False
-            for row in range(self.map_h):
-                if self.map[row][col] == '#':
-                    if not is_rect:
-                        col_rects.append([])
-                        is_rect = True
-                    col_rects[-1].append(row)
-                else:
-                    is_rect = False
-            for i in range(len(col_rects)):
-                row, h = col_rects[i][0], len(col_rects[i])
-                col_rects[i] = pygame.Rect(col * self.cell_w, row * self.cell_h,
-                                           self.cell_w, h * self.cell_h)
-            rects.extend(col_rects)
-        return rects
+        for col, row in self.bundle['spawns'].tolist():
+            spawn_point = SpawnPoint(*self.cell_center(col, row))
+            spawn_point.kill()  # Точка спавна попадает в группу при загрузке своего чанка
+            self.chunk_spawns.setdefault(self.get_chunk(col, row), []).append(spawn_point)
+
+    def get_chunk(self, col, row):
+        return col // self.chunk_size, row // self.chunk_size
+
+    def point_chunk(self, x, y):
+        return self.get_chunk(int(x) // self.cell_w, int(y) // self.cell_h)
+
+    def visible_chunks(self, x, y):
+        # Чанки, которые задевает экран с центром в точке (x, y), с запасом STREAM_MARGIN чанков
+        col0, row0 = self.point_chunk(max(0, x - WIDTH // 2), max(0, y - HEIGHT // 2))
+        col1, row1 = self.point_chunk(min(self.width - 1, x + WIDTH // 2),
+                                      min(self.height - 1, y + HEIGHT // 2))
+        last_col, last_row = self.get_chunk(self.map_w - 1, self.map_h - 1)
+        cols = range(max(0, col0 - STREAM_MARGIN), min(last_col, col1 + STREAM_MARGIN) + 1)
+        rows = range(max(0, row0 - STREAM_MARGIN), min(last_row, row1 + STREAM_MARGIN) + 1)
+        return {(col, row) for col in cols for row in rows}
+
+    def load_chunk(self, chunk):
+        walls = [Wall(rect.x, rect.y, rect.w, rect.h) for rect in self.chunk_rects.get(chunk, ())]
+        for wall in walls:
+            self.obstacles.add(wall.rect)
+        self.chunk_walls[chunk] = walls
+        self.loaded[chunk[1], chunk[0]] = True
+        for spawn_point in self.chunk_spawns.get(chunk, ()):
+            spawn_point.wake(self.difficulty_coeff)
+        for x, y, complexity, hp in self.dormant.pop(chunk, ()):
+            enemy = enemies.spawn(x, y, complexity)
+            enemy.hp = hp
+            enemy.in_spawn_point = False
+
+    def unload_chunk(self, chunk):
+        for wall in self.chunk_walls.pop(chunk):
+            self.obstacles.remove(wall.rect)
+            wall.kill()
+        self.loaded[chunk[1], chunk[0]] = False
+        for spawn_point in self.chunk_spawns.get(chunk, ()):
+            spawn_point.kill()
+
+    def sleep_enemy(self, i, chunk):
+        # Враг в выгруженном чанке хранится только положением, типом и здоровьем
+        x, y = enemies.centers[i].astype(np.int64).tolist()
+        self.dormant.setdefault(chunk, []).append((x, y, int(enemies.complexity[i]),
+                                                   float(enemies.hp[i])))
+        enemies.remove(i)
+
+    def update_chunks(self, x, y):
+        # Загружает чанки рядом с экраном и выгружает дальние вместе с врагами в них
+        chunks = self.visible_chunks(x, y)
+        loaded = set(self.chunk_walls)
+        if chunks != loaded:
+            for chunk in sorted(loaded - chunks):
+                self.unload_chunk(chunk)
+            for chunk in sorted(chunks - loaded):
+                self.load_chunk(chunk)
+            # Стенки для движка рейкаста 'cycle'
+            self.ray_obstacles = List([(wall.rect.x, wall.rect.y, wall.rect.w, wall.rect.h)
+                                       for wall in walls_group])
+            self.version += 1
+        indices = enemies.indices()
+        cols, rows = (enemies.centers[indices].astype(np.int64) //
+                      (self.cell_w, self.cell_h) // self.chunk_size).T
+        asleep = ~self.loaded[rows, cols]
+        for i, col, row in zip(*(array[asleep].tolist() for array in (indices, cols, rows))):
+            self.sleep_enemy(i, (col, row))
+
+    def create_pvs(self):
+        # Предрасчет видимости между клетками: уровень не меняется после создания
+        if self.map_w * self.map_h > PVS_MAX_CELLS:
+            return np.zeros((0, 0), dtype=np.uint8)
+        return build_pvs(self.grid, self.cell_w, self.cell_h)
+
+    def pvs_memory(self):
+        # Возвращает размер PVS в байтах
+        return self.pvs.nbytes
+
+    def loaded_window(self):
+        # Прямоугольник клеток, который покрывает все загруженные чанки
+        rows, cols = np.nonzero(self.loaded)
+        return (cols.min() * self.chunk_size, rows.min() * self.chunk_size,
+                min(self.map_w, (cols.max() + 1) * self.chunk_size),
+                min(self.map_h, (rows.max() + 1) * self.chunk_size))
 
     def distance_to_player(self):
-        # Рассчитывает и возвращает матрицу с расстояниями до игрока на каждой клетке карты
-        inf = 1000
-        x, y = player.x // self.cell_w, player.y // self.cell_h
-        self.distances = [[inf if col != '#' else '#' for col in row]
-                          for row in self.map]
-        self.distances[y][x] = 0
-
-        queue = deque()
-        queue.append((y, x))
-
-        while queue:
-            row, col = queue.popleft()
-            for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)):
-                if dr or dc:
-                    next_row, next_col = row + dr, col + dc
-                    if (self.cell_in_map(next_row, next_col) and
-                            self.distances[next_row][next_col] == inf):
-                        self.distances[next_row][next_col] = self.distances[row][col] + 1
-                        queue.append((next_row, next_col))
-
-    def cell_in_map(self, row, col):
-        return 0 <= row < self.map_h and 0 <= col < self.map_w
-
-    def cheapest_path(self, row, col):
-        # Возвращает следующую точку, в которую следует идти, чтобы приблизиться к игроку
-        if self.distances[row][col] != '#':
-            for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)):
-                next_row, next_col = row + dr, col + dc
-                if ((dr or dc) and self.cell_in_map(next_row, next_col) and
-                        self.distances[next_row][next_col] != '#' and
-                        self.distances[next_row][next_col] < self.distances[row][col]):
-                    return next_col, next_row
-        return row, col
+        # Рассчитывает матрицу с расстояниями до игрока и поле направлений в окне загруженных
+        # чанков. Пока игрок не сменил клетку и не загрузились новые чанки, пересчет не нужен
+        cell = (player.y // self.cell_h, player.x // self.cell_w)
+        window = self.loaded_window()
+        if cell != self.player_cell or window != self.flow_window:
+            col0, row0, col1, row1 = window
+            if self.distances.shape != (row1 - row0, col1 - col0):
+                self.distances = np.empty((row1 - row0, col1 - col0), dtype=np.int32)
+                self.directions = np.empty((row1 - row0, col1 - col0, 2), dtype=np.int32)
+            self.player_cell, self.flow_window = cell, window
+            flow_field(np.ascontiguousarray(self.grid[row0:row1, col0:col1]),
+                       cell[0] - row0, cell[1] - col0, self.distances, self.directions)
 
     def update_score(self):
         # Увеличивает счетчик
@@ -186,9 +602,26 @@ class Level:
             self.difficulty_changed = True
             self.difficulty_coeff *= 1.5
 
+    def update_visibility(self):
+        # Одним вызовом проверяет, видят ли игрока точки спавна, которым подошла очередь
+        # в планировщике EnemyAI. Видимость для врагов считается в EnemyAI.think
+        spawn_points = spawn_points_group.sprites()
+        positions = np.array([(spawn_point.x, spawn_point.y) for spawn_point in spawn_points],
+                             dtype=np.float64).reshape(-1, 2)
+        spawn_points = [spawn_point for spawn_point, due
+                        in zip(spawn_points, AI.spawn_points_due(positions)) if due]
+        pairs = [(spawn_point.x, spawn_point.y, player.x, player.y)
+                 for spawn_point in spawn_points]
+        visible = in_view_batch(np.array(pairs, dtype=np.float64).reshape(-1, 4),
+                                self.grid, self.pvs, self.cell_w, self.cell_h)
+        for i, spawn_point in enumerate(spawn_points):
+            spawn_point.player_in_view = visible[i]
+
     def update(self):
         self.update_difficulty()
+        self.update_chunks(player.x, player.y)
         self.distance_to_player()
+        self.update_visibility()
 
 
 class SpawnPoint(pygame.sprite.Sprite):
@@ -199,6 +632,7 @@ class SpawnPoint(pygame.sprite.Sprite):
         self.spawn_time = spawn_time  # Время до появления след врага
         self.timer = 0  # Отсчитывает время поялвения врага
         self.last_enemy = None
+        self.player_in_view = False  # Обновляется в Level.update_visibility
 
     def can_spawn(self):
         # Проверяет, можно ли заспавнить врага и мониторит, не находится ли последний заспавненный
@@ -206,19 +640,24 @@ class SpawnPoint(pygame.sprite.Sprite):
         if not self.last_enemy:
             return True
         return (self.timer <= 0 and
-                not in_view(self.x, self.y, player.x, player.y,
-                            ray_obstacles) and
+                not self.player_in_view and
                 not self.last_enemy.in_spawn_point)
 
-    def update_difficulty(self):
+    def update_difficulty(self, difficulty_coeff):
         if self.spawn_time > FPS // 2:
-            self.spawn_time = FPS * 7 / level.difficulty_coeff
+            self.spawn_time = FPS * 7 / difficulty_coeff
+
+    def wake(self, difficulty_coeff):
+        # Точка спавна в загруженном чанке: пока чанк был выгружен, сложность могла вырасти
+        spawn_points_group.add(self)
+        if self.spawn_time > FPS:
+            self.update_difficulty(difficulty_coeff)
 
     def update(self):
         if level.difficulty_changed and self.spawn_time > FPS:
-            self.update_difficulty()
+            self.update_difficulty(level.difficulty_coeff)
         if self.can_spawn():
-            self.last_enemy = Enemy(self.x, self.y, choice(self.types))
+            self.last_enemy = enemies.spawn(self.x, self.y, choice(self.types))
             self.timer = self.spawn_time
         self.timer -= 1
 
@@ -292,8 +731,10 @@ class Drop(pygame.sprite.Sprite):
         else:
             player.hp = player.max_hp
 
+    def draw(self):
+        SCREEN.blit(self.image, self.rect.move(-camera.x, -camera.y))
+
     def update(self):
-        SCREEN.blit(self.image, self.rect)
         self.pick_up()
 
 
@@ -311,41 +752,112 @@ class Wall(pygame.sprite.Sprite):
                                            self.w, self.h))
 
 
+class SpatialHash:
+    # Равномерная сетка с размером ячейки как у клетки уровня. Хранит стенки загруженных чанков,
+    # поиск препятствий идет только по соседним ячейкам
+    def __init__(self, cell_w, cell_h):
+        self.cell_w = cell_w
+        self.cell_h = cell_h
+        self.buckets = {}  # (col, row) -> {id ректа: рект}
+        self.cells = {}  # id ректа -> (col0, row0, col1, row1) занятые ячейки
+        self.order = {}  # id ректа -> порядковый номер добавления
+        self.counter = 0
+
+    def get_cells(self, rect):
+        return (rect.left // self.cell_w, rect.top // self.cell_h,
+                (rect.right - 1) // self.cell_w, (rect.bottom - 1) // self.cell_h)
+
+    def link(self, rect, cells):
+        col0, row0, col1, row1 = cells
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                self.buckets.setdefault((col, row), {})[id(rect)] = rect
+        self.cells[id(rect)] = cells
+
+    def unlink(self, rect):
+        col0, row0, col1, row1 = self.cells.pop(id(rect))
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                del self.buckets[col, row][id(rect)]
+
+    def add(self, rect):
+        self.link(rect, self.get_cells(rect))
+        self.order[id(rect)] = self.counter
+        self.counter += 1
+
+    def remove(self, rect):
+        self.unlink(rect)
+        del self.order[id(rect)]
+
+    def query(self, rect):
+        # Возвращает препятствия из ячеек, которые задевает рект, в порядке добавления
+        found = {}
+        col0, row0, col1, row1 = self.get_cells(rect)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                bucket = self.buckets.get((col, row))
+                if bucket:
+                    found.update(bucket)
+        return [found[key] for key in sorted(found, key=self.order.__getitem__)]
+
+    def __len__(self):
+        return len(self.cells)
+
+
 class Floor(pygame.sprite.Sprite):
+    cache = {}  # (номер спрайта пола, разрешение) -> собранный пол
+
     def __init__(self):
         super(Floor, self).__init__(all_sprites)
-        self.image = Image.open(f'data/floor{randint(1, 6)}.png')
-        self.result_floor_image = Image.new('RGB', (WIDTH, HEIGHT))
+        self.index = randint(1, 6)
+        self.tile = ASSETS.image(f'data/floor{self.index}.png')
         self.image = self.create_floor()
         self.rect = self.image.get_rect()
 
     def create_floor(self):
-        # Склеивает спрайты пола в зависимости от разрешения экрана
-        w = WIDTH // self.image.width
-        h = HEIGHT // self.image.height
-        for row in range(h * 5):
-            for col in range(w * 5):
-                self.result_floor_image.paste(self.image,
-                                              (col * self.image.width, row * self.image.height))
-        self.result_floor_image.save('data/floor_result.png')
-        self.image = load_image('floor_result.png')
-        return self.image
+        # Склеивает спрайты пола в зависимости от разрешения экрана. Пол больше экрана на один
+        # спрайт, чтобы при прокрутке его можно было сдвинуть на часть спрайта. Собранный пол
+        # кэшируется в памяти и, если задан FLOOR_CACHE_DIR, на диске
+        key = self.index, WIDTH, HEIGHT
+        if key in self.cache:
+            return self.cache[key]
+        tile = self.tile
+        width, height = WIDTH + tile.get_width(), HEIGHT + tile.get_height()
+        path = self.cache_path(tile, width, height)
+        if path and os.path.isfile(path):
+            floor = pygame.image.load(path).convert()
+        else:
+            floor = pygame.Surface((width, height)).convert()
+            for row in range(ceil(height / tile.get_height())):
+                for col in range(ceil(width / tile.get_width())):
+                    floor.blit(tile, (col * tile.get_width(), row * tile.get_height()))
+            if path:
+                os.makedirs(FLOOR_CACHE_DIR, exist_ok=True)
+                pygame.image.save(floor, path)
+        self.cache[key] = floor
+        return floor
+
+    def cache_path(self, tile, width, height):
+        # Имя файла на диске зависит от содержимого спрайта и размера пола
+        if FLOOR_CACHE_DIR is None:
+            return None
+        digest = hashlib.sha1(pygame.image.tostring(tile, 'RGBA'))
+        digest.update(f'{width}x{height}'.encode())
+        return os.path.join(FLOOR_CACHE_DIR, f'floor_{digest.hexdigest()}.bmp')
 
 
 class Character(pygame.sprite.Sprite):
     def __init__(self):
         super().__init__()
-        self.collision_rect = pygame.Rect(0, 0, 25, 25)
+        self.collision_rect = pygame.Rect(0, 0, COLLISION_SIZE, COLLISION_SIZE)
 
-    def movement(self, dx, dy, enemies=True):
+    def movement(self, dx, dy):
         # Метод обрабатывает столкновение игрока с препятствиями и меняет его координаты
         # Изменение по x
         x, y = self.collision_rect.x, self.collision_rect.y
         self.collision_rect.x += dx
-        for block in obstacles:
-            if (block != self.collision_rect and self.collision_rect.colliderect(block) and
-                    ((block not in enemy_rects) or
-                     (block in enemy_rects and enemies))):
+        for block in obstacles.query(self.collision_rect):
+            if block != self.collision_rect and self.collision_rect.colliderect(block):
                 if dx < 0:
                     self.collision_rect.left = block.right
                 elif dx > 0:
@@ -354,10 +866,8 @@ class Character(pygame.sprite.Sprite):
 
         # Изменение по y
         self.collision_rect.y += dy
-        for block in obstacles:
-            if (block != self.collision_rect and self.collision_rect.colliderect(block) and
-                    ((block not in enemy_rects) or
-                     (block in enemy_rects and enemies))):
+        for block in obstacles.query(self.collision_rect):
+            if block != self.collision_rect and self.collision_rect.colliderect(block):
                 if dy < 0:
                     self.collision_rect.top = block.bottom
                 elif dy > 0:
@@ -366,9 +876,15 @@ class Character(pygame.sprite.Sprite):
 
         # Проверка на крайний случай, если вдруг персонаж вышел за стену
         # Нужна, если персонаж обладет большой скоростью
-        if not in_view(x, y, self.collision_rect.x, self.collision_rect.y, ray_obstacles):
+        if not in_view_grid(x, y, self.collision_rect.x, self.collision_rect.y,
+                            level.grid, level.cell_w, level.cell_h):
             self.collision_rect.x, self.collision_rect.y = x, y
 
+    def interpolate(self, alpha):
+        # Положение между прошлым (alpha = 0) и текущим (alpha = 1) шагом симуляции
+        x, y = self.previous
+        return x + (self.x - x) * alpha, y + (self.y - y) * alpha
+
     def update_angle(self, x1, y1):
         x0, y0 = self.rect.centerx, self.rect.centery
         view_angle = atan2(y1 - y0, x1 - x0)  # Считает угол относительно курсора
@@ -376,24 +892,31 @@ class Character(pygame.sprite.Sprite):
 
 
 class Player(Character):
-    def __init__(self, fov, speed):
+    def __init__(self, fov, speed, ray_engine=RAY_ENGINE):
         super().__init__()
         self.x, self.y = level.player_location()
         self.v = speed
         self.fov = fov  # Угол обзора игрока
+        self.ray_engine = ray_engine
         self.max_hp = 100
         self.hp = self.max_hp
 
         self.immortality_timer = 45
         self.is_dead = False
 
-        self.image = pygame.image.load('data/player.png').convert_alpha()
+        self.image = ASSETS.image('data/player.png')
         self.current_image = self.image
         self.rect = self.current_image.get_rect()
         self.rect.center = self.x, self.y
         self.collision_rect.center = self.rect.center
+        self.previous = self.x, self.y  # Положение на прошлом шаге симуляции
 
-        self.view_angle = self.update_angle(*pygame.mouse.get_pos())
+        self.view_angle = self.update_angle(*camera.to_world(*INPUT.mouse_pos()))
+        # Буфер вершин многоугольника тени: рамка экрана и по точке на каждый луч
+        self.rays = np.empty((FRAME_VERTICES + 2 * fov + 1, 2), dtype=np.int32)
+        self.visibility = VisibilityCache(fov)
+        self.view_rect = pygame.Rect(0, 0, WIDTH, HEIGHT)
+        self.dirty_rects = []  # Области экрана, измененные игроком за кадр
 
     def death(self):
         if self.hp <= 0:
@@ -401,24 +924,58 @@ class Player(Character):
 
     def move_character(self):
         # Здесь происходит управление игроком
-        keys = pygame.key.get_pressed()
+        keys = INPUT.keys()
         if keys[pygame.K_w]:
-            self.movement(0, -self.v, enemies=False)
+            self.movement(0, -self.v)
         if keys[pygame.K_s]:
-            self.movement(0, self.v, enemies=False)
+            self.movement(0, self.v)
         if keys[pygame.K_a]:
-            self.movement(-self.v, 0, enemies=False)
+            self.movement(-self.v, 0)
         if keys[pygame.K_d]:
-            self.movement(self.v, 0, enemies=False)
+            self.movement(self.v, 0)
         self.x, self.y = self.collision_rect.center
         self.rect.center = self.x, self.y
 
-    def ray_cast(self):
-        coords = self.start_ray_coords(self.x, self.y, self.view_angle)
-        coords.extend(ray_cycle(self.x, self.y, self.view_angle, ray_obstacles, level.cell_w,
-                                level.cell_h, level.map_w, level.map_h, self.fov))
+    def ray_cast(self, x, y):
+        # Лучи считаются в координатах мира (x, y), а тень рисуется в координатах экрана
+        screen_x, screen_y = camera.to_screen(x, y)
+        if self.ray_engine == 'polygon':
+            hits = visibility_polygon(x, y, self.view_angle, level.segments, self.fov)
+            hits = np.array(hits, dtype=np.int32).reshape(-1, 2) - (camera.x, camera.y)
+            coords = self.start_ray_coords(screen_x, screen_y, self.view_angle)
+            coords.extend(hits.tolist())
+        else:
+            # Лучи из точки (x, y), округленной до VISIBILITY_STEP, берутся из кэша или
+            # досчитываются, затем переносятся в буфер self.rays после рамки экрана, и вершины
+            # на одной прямой склеиваются
+            x = round(x / VISIBILITY_STEP) * VISIBILITY_STEP
+            y = round(y / VISIBILITY_STEP) * VISIBILITY_STEP
+            first = round(self.view_angle * 100) - self.fov
+            points = self.visibility.get((x, y, self.ray_engine, level.version), first,
+                                         partial(self.cast_rays, x, y))
+            start = screen_frame(screen_x, screen_y, self.view_angle, WIDTH, HEIGHT, self.rays)
+            end = start + len(points)
+            self.rays[start:end] = points
+            end = collapse_vertices(self.rays, start, end)
+            self.rays[start:end] -= (camera.x, camera.y)
+            coords, hits = self.rays[:end], self.rays[start:end]
         pygame.draw.polygon(SCREEN, 'black', coords)
 
+        # Видимая область лежит между игроком и точками пересечения лучей со стенами
+        left = min(int(hits[:, 0].min()), screen_x)
+        top = min(int(hits[:, 1].min()), screen_y)
+        right = max(int(hits[:, 0].max()), screen_x)
+        bottom = max(int(hits[:, 1].max()), screen_y)
+        self.view_rect = pygame.Rect(left, top, right - left, bottom - top).inflate(4, 4)
+
+    def cast_rays(self, x, y, out, start, first, count):
+        # Лучи из точки (x, y) под углами (first + i) / 100, i < count, в строки out со start
+        if self.ray_engine == 'dda':
+            ray_fan_dda(x, y, first, count, level.grid, level.cell_w, level.cell_h, out, start)
+        else:
+            ray_fan_cycle(x, y, first, count, level.ray_obstacles, level.cell_w, level.cell_h,
+                          level.map_w, level.map_h, out, start)
+
     def set_immortal(self):
         # Устанавливает бессмертие у игрока после получения урона
         self.immortality_timer = 45
@@ -445,127 +1002,336 @@ class Player(Character):
                     (0, HEIGHT), (0, 0), (WIDTH, 0), (x, y)]
 
     def update(self):
+        self.previous = self.x, self.y
         self.immortality_timer -= 1
         self.death()
         self.move_character()
-        self.ray_cast()
-        self.view_angle = self.update_angle(*pygame.mouse.get_pos())
-        self.current_image = pygame.transform.rotate(self.image, -degrees(self.view_angle))
-        # pygame.draw.rect(SCREEN, 'white', self.collision_rect)
-        SCREEN.blit(self.current_image, self.rect)
-
-
-class Enemy(Character):
-    def __init__(self, x, y, complexity):
-        super(Enemy, self).__init__()
-        self.spawn_x, self.spawn_y = x, y
-        self.x = x
-        self.y = y
-        self.location = (self.y // level.cell_h, self.x // level.cell_w)
-        self.destination = self.location  # Точка, в которую нужно идти
-
-        self.hp, self.dmg, self.speed = ENEMY_TYPES[complexity]
-        self.hp = ceil(self.hp * level.difficulty_coeff)
-        self.speed_debuff = 0  # Дебафф к скорости при попадании
-
-        self.view_angle = 0
-
-        self.image = ENEMY_IMAGE
-        self.current_image = self.image
+        self.view_angle = self.update_angle(*camera.to_world(*INPUT.mouse_pos()))
+        self.current_image = ROTATIONS.get(self.image, -degrees(self.view_angle))
 
-        self.rect = self.current_image.get_rect()
-        self.rect.center = self.x, self.y
-        self.collision_rect.center = self.rect.center
-
-        # Счетчик для эффекта кровотечения нужен для того, чтобы при большой
-        # скорострельности не жралось фпс из-за большого кол-ва спрайтов
-        self.bleed_time = 20
-        self.bleed_timer = 0
-
-        self.in_spawn_point = True
-
-        obstacles.append(self.collision_rect)
-        enemy_rects.append(self.collision_rect)
-        enemies_group.add(self)
-
-    def attack(self):
-        if self.collision_rect.colliderect(player.collision_rect) and player.immortality_timer <= 0:
-            player.hp -= self.dmg
-            player.set_immortal()
+    def draw(self, alpha=1.0):
+        x, y = self.interpolate(alpha)
+        self.ray_cast(x, y)
+        # pygame.draw.rect(SCREEN, 'white', self.collision_rect)
+        center = camera.to_screen(x, y)
+        self.dirty_rects = [self.view_rect,
+                            SCREEN.blit(self.current_image,
+                                        self.current_image.get_rect(center=center))]
+
+
+class EnemyPool:
+    # Все враги хранятся в заранее выделенных массивах, как летающие объекты в ParticlePool:
+    # здоровье, скорость, замедление, положение, рект столкновений и таймеры. Перемещение, атака
+    # и смерть считаются сразу для всех врагов, а ячейки исчезнувших врагов переиспользуются.
+    # Доступ к отдельному врагу дает представление Enemy
+
+    # Счетчик для эффекта кровотечения нужен для того, чтобы при большой
+    # скорострельности не жралось фпс из-за большого кол-ва спрайтов
+    BLEED_TIME = 20
+
+    def __init__(self, capacity=64):
+        self.centers = np.zeros((capacity, 2))  # Центр врага
+        self.previous = np.zeros((capacity, 2))  # Центр на прошлом шаге симуляции
+        # Левый верхний угол ректа столкновений COLLISION_SIZE x COLLISION_SIZE
+        self.boxes = np.zeros((capacity, 2), dtype=np.int64)
+        self.spawns = np.zeros((capacity, 2))  # Точка спавна
+        self.velocities = np.zeros((capacity, 2))  # Смещение за шаг
+        self.destinations = np.zeros((capacity, 2), dtype=np.int64)  # Следующая клетка пути
+        self.angles = np.zeros(capacity)  # Угол поворота к цели
+        self.hp = np.zeros(capacity)
+        self.dmg = np.zeros(capacity, dtype=np.int64)
+        self.speed = np.zeros(capacity)
+        self.debuff = np.zeros(capacity)  # Дебафф к скорости при попадании
+        self.complexity = np.zeros(capacity, dtype=np.int64)  # Тип врага в ENEMY_TYPES
+        self.bleed_timer = np.zeros(capacity, dtype=np.int64)
+        self.in_view = np.zeros(capacity, dtype=np.bool_)  # Видит ли враг игрока
+        self.in_spawn_point = np.zeros(capacity, dtype=np.bool_)
+        self.ai_wait = np.zeros(capacity, dtype=np.int64)  # Шагов с последнего решения EnemyAI
+        self.serial = np.zeros(capacity, dtype=np.int64)  # Сколько врагов побывало в ячейке
+        self.alive = np.zeros(capacity, dtype=np.bool_)
+        self.free = []  # Свободные ячейки
+
+    def grow(self):
+        # Увеличивает пул в 2 раза, если свободных ячеек не осталось
+        capacity = len(self.alive)
+        for name in ('centers', 'previous', 'boxes', 'spawns', 'velocities', 'destinations',
+                     'angles', 'hp', 'dmg', 'speed', 'debuff', 'complexity', 'bleed_timer',
+                     'in_view', 'in_spawn_point', 'ai_wait', 'serial', 'alive'):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+        self.free.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def spawn(self, x, y, complexity):
+        # Создает врага с центром в (x, y) и возвращает его представление
+        if not self.free:
+            self.free = np.flatnonzero(~self.alive)[::-1].tolist()
+            if not self.free:
+                self.grow()
+        i = self.free.pop()
+        hp, self.dmg[i], self.speed[i] = ENEMY_TYPES[complexity]
+        self.hp[i] = ceil(hp * level.difficulty_coeff)
+        self.debuff[i] = 0
+        self.complexity[i] = complexity
+        self.centers[i] = self.previous[i] = self.spawns[i] = x, y
+        self.boxes[i] = int(x) - COLLISION_SIZE // 2, int(y) - COLLISION_SIZE // 2
+        self.velocities[i] = 0, 0
+        self.destinations[i] = x // level.cell_w, y // level.cell_h
+        self.angles[i] = 0
+        self.in_view[i] = False
+        self.in_spawn_point[i] = True
+        # Первые решения дальних врагов, появившихся в одном кадре, расходятся по разным кадрам
+        self.ai_wait[i] = i % AI.far_period
+        self.bleed_timer[i] = 0
+        self.serial[i] += 1
+        self.alive[i] = True
+        return Enemy(self, i)
+
+    def remove(self, i):
+        self.alive[i] = False
+
+    def indices(self):
+        return np.flatnonzero(self.alive)
+
+    def rects(self, indices):
+        # Ректы спрайтов врагов (x, y, w, h), спрайт выводится с центром в центре врага
+        w, h = ENEMY_IMAGE.get_size()
+        rects = np.empty((len(indices), 4))
+        rects[:, :2] = self.centers[indices] - (w // 2, h // 2)
+        rects[:, 2:] = w, h
+        return rects
 
-    def dead(self):
+    def dead(self, i):
         level.update_score()
-        obstacles.remove(self.collision_rect)
-        enemy_rects.remove(self.collision_rect)
+        x, y = self.centers[i].astype(np.int64).tolist()
         chance = random()
         if chance <= 0.3:
-            Drop(self.x, self.y)
-        self.bleed_timer = 0
-        self.bleed()
-        self.kill()
-
-    def bleed(self, k=0):
-        if self.bleed_timer <= 0:
+            Drop(x, y)
+        self.bleed_timer[i] = 0
+        self.bleed(i)
+        self.remove(i)
+
+    def bleed(self, i, k=0):
+        if self.bleed_timer[i] <= 0:
+            x, y = self.centers[i].astype(np.int64).tolist()
             for _ in range(randint(15 + k, 30 + k * 2)):
-                Blood(*self.rect.center, randint(-314, 314) / 100,
-                      randint(5 + k, 15 + k), -0.5)
-            self.bleed_timer = self.bleed_time
-
-    def update_spawn_status(self):
-        # Метод проверяет, не находится ли последний заспавненный враг в точке спавна, дабы
-        # не заспавнить еще одного врага внутри другого
-        if (self.in_spawn_point and
-                not self.collision_rect.collidepoint(self.spawn_x, self.spawn_y)):
-            self.in_spawn_point = False
-
-    def set_impact(self):
-        # Замедляет игрока при попадании
-        self.speed_debuff = self.speed * 0.5
-        self.bleed(-10)
-
-    def update_impact(self):
-        # Отсчитывет время замедления врага
-        if self.speed_debuff > 0:
-            self.speed_debuff -= self.speed * 0.01
-
-    def move(self):
-        # Метод ищет следующую точку пути
-        ray_coords = (self.rect.topleft, self.rect.topright,
-                      self.rect.bottomright, self.rect.bottomleft)
-        # Проверяет, находится ли игрок в зоне видимости
-        if all((in_view(*pos, player.collision_rect.centerx,
-                        player.collision_rect.centery, ray_obstacles) for pos in ray_coords)):
-            self.view_angle = atan2(player.y - self.y, player.x - self.x)
-        else:
-            x1, y1 = self.destination
-            self.view_angle = atan2(y1 * level.cell_h + level.cell_h // 2 - self.y,
-                                    x1 * level.cell_w + level.cell_w // 2 - self.x)
-
-        vx = cos(self.view_angle) * (self.speed - self.speed_debuff)
-        vy = sin(self.view_angle) * (self.speed - self.speed_debuff)
-        self.movement(vx, vy)
+                particles.add_blood(x, y, randint(-314, 314) / 100, randint(5 + k, 15 + k), -0.5)
+            self.bleed_timer[i] = self.BLEED_TIME
+
+    def set_impact(self, i):
+        # Замедляет врага при попадании
+        self.debuff[i] = self.speed[i] * 0.5
+        self.bleed(i, -10)
+
+    def attack(self, indices):
+        # Бьет игрока первый враг, рект столкновений которого пересекается с ректом игрока
+        if player.immortality_timer > 0:
+            return
+        target = player.collision_rect
+        x, y = self.boxes[indices].T
+        touching = ((x < target.right) & (target.left < x + COLLISION_SIZE) &
+                    (y < target.bottom) & (target.top < y + COLLISION_SIZE))
+        attackers = indices[touching]
+        if len(attackers):
+            player.hp -= int(self.dmg[attackers[0]])
+            player.set_immortal()
 
     def update(self):
-        if self.hp <= 0:
-            self.dead()
-        self.bleed_timer -= 1
-
-        self.view_angle = self.update_angle(player.x, player.y)
-        self.location = (self.collision_rect.y // level.cell_h,
-                         self.collision_rect.x // level.cell_w)
-        self.destination = level.cheapest_path(*self.location)
-
-        self.move()
-        self.update_impact()
-        self.attack()
-        self.update_spawn_status()
-
-        # pygame.draw.rect(SCREEN, 'white', self.collision_rect)
-        self.x, self.y = self.collision_rect.center
-        self.rect.center = self.x, self.y
-        self.current_image = pygame.transform.rotate(self.image, -degrees(self.view_angle))
-
-        SCREEN.blit(self.current_image, self.rect)
+        for i in np.flatnonzero(self.alive & (self.hp <= 0)).tolist():
+            self.dead(i)
+        indices = self.indices()
+        self.previous[indices] = self.centers[indices]
+        self.bleed_timer[indices] -= 1
+
+        # Направление к игроку или к следующей клетке пути уже выбрано в EnemyAI.think
+        move_enemies(indices, self.boxes, self.velocities, self.alive, level.grid, level.cell_w,
+                     level.cell_h, COLLISION_SIZE)
+        # Замедление после попадания проходит постепенно
+        slowed = indices[self.debuff[indices] > 0]
+        self.debuff[slowed] -= self.speed[slowed] * 0.01
+        self.attack(indices)
+
+        # Враг покидает точку спавна, когда его рект столкновений перестает ее накрывать. Пока
+        # последний заспавненный враг в точке спавна, новый враг в ней не появляется
+        boxes, spawns = self.boxes[indices], self.spawns[indices]
+        self.in_spawn_point[indices] &= ((boxes <= spawns) &
+                                         (spawns < boxes + COLLISION_SIZE)).all(axis=1)
+        self.centers[indices] = self.boxes[indices] + COLLISION_SIZE // 2
+
+    def draw(self, alpha=1.0):
+        # Враги выводятся между прошлым (alpha = 0) и текущим (alpha = 1) шагом симуляции
+        indices = self.indices()
+        previous = self.previous[indices]
+        centers = previous + (self.centers[indices] - previous) * alpha - (camera.x, camera.y)
+        images = [ROTATIONS.get(ENEMY_IMAGE, -degrees(angle))
+                  for angle in self.angles[indices].tolist()]
+        SCREEN.blits([(image, image.get_rect(center=center))
+                      for image, center in zip(images, centers.tolist())], False)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+
+class Enemy:
+    # Представление врага из ячейки index пула EnemyPool. В ячейке после смерти врага может
+    # появиться новый, поэтому представление помнит номер своего врага в ячейке (serial)
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.serial = int(pool.serial[index])
+
+    @property
+    def alive(self):
+        return bool(self.pool.alive[self.index]) and self.pool.serial[self.index] == self.serial
+
+    @property
+    def x(self):
+        return float(self.pool.centers[self.index, 0])
+
+    @property
+    def y(self):
+        return float(self.pool.centers[self.index, 1])
+
+    @property
+    def complexity(self):
+        return int(self.pool.complexity[self.index])
+
+    @property
+    def hp(self):
+        return float(self.pool.hp[self.index])
+
+    @hp.setter
+    def hp(self, value):
+        self.pool.hp[self.index] = value
+
+    @property
+    def in_spawn_point(self):
+        # Исчезнувший враг не занимает точку спавна
+        return self.alive and bool(self.pool.in_spawn_point[self.index])
+
+    @in_spawn_point.setter
+    def in_spawn_point(self, value):
+        self.pool.in_spawn_point[self.index] = value
+
+
+class EnemyAI:
+    # Решения врагов считаются до их перемещения в think_enemies без GIL. Враги делятся на части
+    # по потокам, каждая часть пишет только свои строки массивов, поэтому результат не зависит
+    # от числа потоков. Применяются решения в EnemyPool.update в главном потоке.
+    # Планировщик делит врагов на ярусы: ближние решают каждый кадр, дальние - раз в far_period
+    # кадров. Дальние решения считаются частями, начиная с самых давних, пока не исчерпан бюджет
+    # budget_ms на кадр (None - без ограничения), остальные враги до своей очереди двигаются
+    # по прошлому решению. При повторе записи число дальних решений задает quota
+    def __init__(self, workers=AI_WORKERS, shard=AI_SHARD, budget_ms=AI_BUDGET_MS,
+                 far_period=AI_FAR_PERIOD):
+        self.workers = workers
+        self.shard = shard
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.budget_ms = budget_ms
+        self.far_period = far_period
+        self.quota = None
+        self.reset()
+
+    def reset(self):
+        # Счетчики планировщика с начала уровня
+        self.frame = 0
+        self.tiers = dict.fromkeys(('near', 'far', 'deferred', 'spawn_points_near',
+                                    'spawn_points_far'), 0)
+        self.last = (0, 0, 0)  # Ближние, дальние и отложенные решения прошлого кадра
+        self.overruns = 0  # Кадры, в которых AI потратил больше бюджета
+        self.time = 0
+        self.max_time = 0
+
+    def split(self, n):
+        # Делит n врагов на части не меньше shard для потоков
+        parts = max(1, min(self.workers, n // self.shard))
+        bounds = np.linspace(0, n, parts + 1).astype(np.int64)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def think(self, pool):
+        start = perf_counter()
+        self.frame += 1
+        indices = pool.indices()
+        pool.ai_wait[indices] += 1
+        # Ближний ярус: враги на экране и враги, которые при прошлом решении видели игрока
+        near = pool.in_view[indices] | self.view().sees(*pool.centers[indices].T, AI_NEAR_MARGIN)
+        far = indices[~near]
+        due = far[pool.ai_wait[far] >= self.far_period]
+        due = due[np.argsort(-pool.ai_wait[due], kind='stable')]
+        self.decide(pool, indices[near])
+
+        if self.quota is not None:
+            done = min(self.quota, len(due))
+            self.decide(pool, due[:done])
+        else:
+            # Хотя бы одна часть дальних врагов за кадр, чтобы при перегрузке они не стояли вечно
+            batch = self.shard * self.workers
+            done = min(batch, len(due))
+            self.decide(pool, due[:done])
+            while done < len(due) and (self.budget_ms is None or
+                                       (perf_counter() - start) * 1000 < self.budget_ms):
+                self.decide(pool, due[done:done + batch])
+                done = min(done + batch, len(due))
+
+        elapsed = perf_counter() - start
+        self.last = (int(near.sum()), done, len(due) - done)
+        for tier, count in zip(('near', 'far', 'deferred'), self.last):
+            self.tiers[tier] += count
+        self.overruns += self.budget_ms is not None and elapsed * 1000 > self.budget_ms
+        self.time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def view(self):
+        # Экран вокруг игрока по состоянию симуляции. Камера в draw_game зависит от интерполяции
+        # между шагами, а решения врагов должны зависеть только от шагов
+        view = Camera(level.width, level.height)
+        view.follow(player.x, player.y)
+        return view
+
+    def decide(self, pool, indices):
+        n = len(indices)
+        if not n:
+            return
+        rects = pool.rects(indices)
+        cells = pool.boxes[indices]
+        centers = pool.centers[indices]
+        speeds = pool.speed[indices] - pool.debuff[indices]
+        in_view = np.empty(n, dtype=np.bool_)
+        destinations = np.empty((n, 2), dtype=np.int64)
+        angles = np.empty(n)
+        velocities = np.empty((n, 2))
+        target_x, target_y = player.collision_rect.center
+        args = (rects, cells, centers, speeds, target_x, target_y, level.grid, level.pvs,
+                level.directions, *level.flow_window[:2], level.cell_w, level.cell_h, in_view,
+                destinations, angles, velocities)
+
+        parts = self.split(n)
+        if self.pool is None or len(parts) == 1:
+            think_enemies(0, n, *args)
+        else:
+            for future in [self.pool.submit(think_enemies, start, end, *args)
+                           for start, end in parts]:
+                future.result()
+
+        pool.in_view[indices] = in_view
+        pool.destinations[indices] = destinations
+        pool.angles[indices] = angles
+        pool.velocities[indices] = velocities
+        pool.ai_wait[indices] = 0
+
+    def spawn_points_due(self, positions):
+        # Какие точки спавна проверяют видимость игрока в этом кадре: точки на экране - каждый
+        # кадр, остальные - по очереди раз в far_period кадров
+        near = self.view().sees(positions[:, 0], positions[:, 1], AI_NEAR_MARGIN)
+        due = near | ((np.arange(len(positions)) + self.frame) % self.far_period == 0)
+        self.tiers['spawn_points_near'] += int(near.sum())
+        self.tiers['spawn_points_far'] += int((due & ~near).sum())
+        return due
+
+    def stats(self):
+        frames = max(self.frame, 1)
+        return {**self.tiers, 'frames': self.frame, 'budget_ms': self.budget_ms,
+                'overruns': self.overruns, 'overrun_rate': self.overruns / frames,
+                'mean_ms': self.time / frames * 1000, 'max_ms': self.max_time * 1000}
 
 
 class Weapon:
@@ -579,152 +1345,349 @@ class Weapon:
         self.multishot = 1  # Кол-во пулек за выстрел
 
     def shot(self, x, y):
-        hover_shoot = pygame.mixer.Sound('sounds/hover_over_the_button.mp3')
-        hover_shoot.set_volume(0.05)
-        hover_shoot.play()
-        mx, my = pygame.mouse.get_pos()
+        ASSETS.sound(*SHOT_SOUND).play()
+        mx, my = camera.to_world(*INPUT.mouse_pos())
         phi = atan2(my - y, mx - x)
         for i in range(-self.multishot // 2, self.multishot // 2):
             alpha = randint(-int(self.accuracy * 1000), int(self.accuracy * 1000))
-            Bullet(x, y, phi + alpha / 1000 + i * self.accuracy, self.v0, self.a,
-                   self.dmg)
-
-
-class BouncingObject(pygame.sprite.Sprite):
-    def __init__(self, x, y, phi, v0, a):
-        super().__init__(bouncing_obj_group)
-        self.point = pygame.Rect(x, y, 1, 1)
-        self.phi = phi  # Угол полета объекта
-        self.v = v0
-        self.a = a
-        self.cos_phi = cos(phi)
-        self.sin_phi = sin(phi)
-
-        self.dx, self.dy = 0, 0
-        self.pos_x = x
-        self.pos_y = y
-
-    def bounce(self):
-        # Рассчитвает рикошет пули
-        for block in obstacles:
-            if block not in enemy_rects and self.point.colliderect(block):
-                x0 = self.pos_x - ((self.v - self.a) * self.cos_phi)
-                y0 = self.pos_y - ((self.v - self.a) * self.sin_phi)
-                # Точка пересечения с ректом
-                x, y = block.clipline(x0, y0, self.pos_x, self.pos_y)[0]
-                if (block.bottom - 2 <= y <= block.bottom + 2 or
-                        block.top - 2 <= y <= block.top + 2):
-                    self.sin_phi = -self.sin_phi
-                    self.phi = -self.phi
-                else:
-                    self.phi = pi - self.phi
-                    self.cos_phi = -self.cos_phi
-                self.v -= 5
-                break
-
-    def update_variables(self):
-        # Апдейтит значения
-        self.dx = self.v * self.cos_phi
-        self.dy = self.v * self.sin_phi
-        self.pos_x = self.pos_x + self.dx
-        self.pos_y = self.pos_y + self.dy
-        self.v += self.a
-
-        self.point.x = self.pos_x
-        self.point.y = self.pos_y
-
-    def change_status(self):
-        if self.v <= 0:
-            self.kill()
-        if self.point.collidelistall(obstacles):
-            self.bounce()
-
-
-class Blood(BouncingObject):
-    def __init__(self, x, y, phi, v0, a):
-        super(Blood, self).__init__(x, y, phi, v0, a)
-        self.current_image = BLOOD_IMAGE
+            particles.add_bullet(x, y, phi + alpha / 1000 + i * self.accuracy, self.v0, self.a,
+                                 self.dmg)
+
+
+class ParticlePool:
+    # Все летающие объекты (кровь и пули) хранятся в заранее выделенных массивах, а не в отдельных
+    # спрайтах. Перемещение и рикошет считаются за один проход update_particles, а ячейки
+    # исчезнувших объектов переиспользуются
+    BLOOD, BULLET = 0, 1
+
+    def __init__(self, capacity=1024):
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.dx = np.zeros(capacity)
+        self.dy = np.zeros(capacity)
+        self.phi = np.zeros(capacity)  # Угол полета объекта
+        self.cos_phi = np.zeros(capacity)
+        self.sin_phi = np.zeros(capacity)
+        self.v = np.zeros(capacity)
+        self.a = np.zeros(capacity)
+        self.dmg = np.zeros(capacity)
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.alive = np.zeros(capacity, dtype=np.bool_)
+        self.free = []  # Свободные ячейки
+
+    def grow(self):
+        # Увеличивает пул в 2 раза, если свободных ячеек не осталось
+        capacity = len(self.alive)
+        for name in ('x', 'y', 'dx', 'dy', 'phi', 'cos_phi', 'sin_phi', 'v', 'a', 'dmg',
+                     'kind', 'alive'):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+        self.free.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def add(self, kind, x, y, phi, v0, a, dmg=0):
+        if not self.free:
+            self.free = np.flatnonzero(~self.alive)[::-1].tolist()
+            if not self.free:
+                self.grow()
+        i = self.free.pop()
+        self.kind[i] = kind
+        self.x[i], self.y[i] = x, y
+        self.dx[i], self.dy[i] = 0, 0
+        self.phi[i] = phi
+        self.cos_phi[i], self.sin_phi[i] = cos(phi), sin(phi)
+        self.v[i], self.a[i] = v0, a
+        self.dmg[i] = dmg
+        self.alive[i] = True
+
+    def add_blood(self, x, y, phi, v0, a):
+        self.add(self.BLOOD, x, y, phi, v0, a)
+
+    def add_bullet(self, x, y, phi, v0, a, dmg):
+        self.add(self.BULLET, x, y, phi, v0, a, dmg)
+
+    def hit(self, start_x, start_y):
+        # Отвечает за удар пуль по врагам: каждая пуля попадает в первого врага на отрезке, который
+        # она пролетела за шаг из (start_x, start_y). Возвращает пары (пуля, ячейка врага)
+        indices = enemies.indices()
+        bullets = np.flatnonzero(self.alive & (self.kind == self.BULLET))
+        if not len(indices) or not len(bullets):
+            return []
+        hp = enemies.hp[indices]
+        targets = np.empty(len(bullets), dtype=np.int64)
+        sweep_bullets(start_x[bullets], start_y[bullets], self.x[bullets], self.y[bullets],
+                      self.dmg[bullets], enemies.rects(indices), hp, level.cell_w, level.cell_h,
+                      level.map_w, targets)
+        enemies.hp[indices] = hp
+        hit = targets >= 0
+        return list(zip(bullets[hit].tolist(), indices[targets[hit]].tolist()))
+
+    def draw(self, alpha=1.0):
+        # За последний шаг объект сместился на (dx, dy), по ним восстанавливается промежуточное
+        # положение
+        x = self.x - self.dx * (1 - alpha) - camera.x
+        y = self.y - self.dy * (1 - alpha) - camera.y
+        blood = np.flatnonzero(self.alive & (self.kind == self.BLOOD))
+        SCREEN.blits([(ROTATIONS.get(BLOOD_IMAGE, -degrees(self.phi[i])),
+                       (int(x[i]), int(y[i]))) for i in blood], False)
+        for i in np.flatnonzero(self.alive & (self.kind == self.BULLET)):
+            pygame.draw.line(SCREEN, 'orange', (x[i] - self.dx[i], y[i] - self.dy[i]),
+                             (x[i], y[i]), 5)
 
     def update(self):
-        self.change_status()
-        self.update_variables()
-
-        self.current_image = pygame.transform.rotate(BLOOD_IMAGE, -degrees(self.phi))
-        SCREEN.blit(self.current_image, self.point)
-
-
-class Bullet(BouncingObject):
-    def __init__(self, player_x, player_y, phi, v0, a, dmg):
-        super(Bullet, self).__init__(player_x, player_y, phi, v0, a)
-        self.dmg = dmg
+        start_x, start_y = self.x.copy(), self.y.copy()
+        update_particles(self.x, self.y, self.dx, self.dy, self.phi, self.cos_phi, self.sin_phi,
+                         self.v, self.a, self.alive, level.grid, level.cell_w, level.cell_h)
+        # Урон уже снят в sweep_bullets
+        for i, j in self.hit(start_x, start_y):
+            enemies.set_impact(j)
+            self.alive[i] = False
 
-    def update(self):
-        self.change_status()
-        self.hit()
-        self.update_variables()
-        # self.current_image = pygame.transform.rotate(BULLET_IMAGE, -degrees(self.phi))
-        # SCREEN.blit(self.current_image, self.point)
-        pygame.draw.line(SCREEN, 'orange', (self.pos_x - self.dx, self.pos_y - self.dy),
-                         (self.pos_x, self.pos_y), 5)
-
-    def hit(self):
-        # Отвечает за удар пули по врагу
-        for enemy in enemies_group:
-            if self.point.colliderect(enemy.rect):
-                enemy.hp -= self.dmg
-                enemy.set_impact()
-                self.kill()
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
 
 
 class Widget:
     def print_text(self, message, x, y, font_color=(0, 0, 0),
                    font_type=None, font_size=32):
-        font_type = pygame.font.Font(font_type, font_size)
-        text = font_type.render(message, True, font_color)
-        SCREEN.blit(text, (x, y))
+        text = ASSETS.font(font_type, font_size).render(message, True, font_color)
+        return SCREEN.blit(text, (x, y))
 
 
 class InterFace(Widget):
+    # Методы отрисовки возвращают измененные области экрана
     def death_panel(self):
         x = WIDTH // 2 - 5 * 32
         y = HEIGHT // 2
-        self.print_text('ПОТРАЧЕНО', x, y, font_color='#B01414', font_size=64)
+        return self.print_text('ПОТРАЧЕНО', x, y, font_color='#B01414', font_size=64)
 
     def hp_bar(self):
         width, height = WIDTH // 14, HEIGHT // 40
         hp = player.hp if player.hp > 0 else 0
         pygame.draw.rect(SCREEN, '#B80A0A', (10, HEIGHT - height - 5,
                                              hp / player.max_hp * width, height))
-        pygame.draw.rect(SCREEN, 'white', (10, HEIGHT - height - 5, width, height), 1)
-        self.print_text(f'{hp} / {player.max_hp}', 20, HEIGHT - height - 5,
-                        font_color='white')
+        bar = pygame.draw.rect(SCREEN, 'white', (10, HEIGHT - height - 5, width, height), 1)
+        return bar.union(self.print_text(f'{hp} / {player.max_hp}', 20, HEIGHT - height - 5,
+                                         font_color='white'))
 
     def pause_bar(self):
         x = WIDTH // 2 - 3 * 32
         y = HEIGHT // 2
-        self.print_text('ПАУЗА', x, y, font_color='white', font_size=64)
+        return self.print_text('ПАУЗА', x, y, font_color='white', font_size=64)
 
     def score_bar(self):
         x = WIDTH // 2 - (len(str(level.score)) + 7) // 2 * 16
         y = HEIGHT - HEIGHT // 40 - 5
-        self.print_text(f'SCORE: {level.score}', x, y, font_color='white')
+        return self.print_text(f'SCORE: {level.score}', x, y, font_color='white')
 
     def fps_counter(self):
-        font = pygame.font.Font(None, 20)
-        text = font.render(str(round(CLOCK.get_fps(), 4)), True, 'white')
+        text = ASSETS.font(None, 20).render(str(round(CLOCK.get_fps(), 4)), True, 'white')
         text_x = 0
         text_y = 0
-        SCREEN.blit(text, (text_x, text_y))
+        return SCREEN.blit(text, (text_x, text_y))
 
     def update(self, pause):
-        self.fps_counter()
+        rects = [self.fps_counter()]
         if not (player.is_dead or pause):
-            self.hp_bar()
-            self.score_bar()
+            rects.append(self.hp_bar())
+            rects.append(self.score_bar())
         elif player.is_dead:
-            self.death_panel()
+            rects.append(self.death_panel())
         elif pause:
-            self.pause_bar()
+            rects.append(self.pause_bar())
+        return rects
+
+
+class Camera:
+    # Левый верхний угол экрана в координатах мира. Камера держит игрока в центре экрана, но не
+    # выходит за границы уровня, поэтому уровень меньше экрана не прокручивается
+    def __init__(self, width, height):
+        self.width, self.height = width, height  # Размер уровня в пикселях
+        self.x = self.y = 0
+
+    def follow(self, x, y):
+        self.x = int(min(max(x - WIDTH // 2, 0), max(self.width - WIDTH, 0)))
+        self.y = int(min(max(y - HEIGHT // 2, 0), max(self.height - HEIGHT, 0)))
+
+    def to_screen(self, x, y):
+        return x - self.x, y - self.y
+
+    def to_world(self, x, y):
+        return x + self.x, y + self.y
+
+    def sees(self, x, y, margin=0):
+        # Попадают ли точки мира (массивы x, y) на экран, расширенный на margin пикселей
+        return ((x >= self.x - margin) & (x < self.x + WIDTH + margin) &
+                (y >= self.y - margin) & (y < self.y + HEIGHT + margin))
+
+
+class Renderer:
+    # Пол и стены собираются в один фон, который пересобирается, только если камера сдвинулась
+    # или загрузились другие чанки уровня. На экран выводятся только области, измененные в этом
+    # или прошлом кадре, а при прокрутке - весь экран
+    def __init__(self):
+        self.background = pygame.Surface((WIDTH, HEIGHT)).convert()
+        self.state = None  # Положение камеры и версия чанков, для которых собран фон
+        self.previous = []  # Области, измененные в прошлом кадре
+        self.full = True  # Следующий кадр выводится целиком
+
+    def build_background(self):
+        self.background.blit(floor.image, (-(camera.x % floor.tile.get_width()),
+                                           -(camera.y % floor.tile.get_height())))
+        for wall in walls_group:
+            pygame.draw.rect(self.background, 'black', wall.rect.move(-camera.x, -camera.y))
+
+    def draw_background(self):
+        state = camera.x, camera.y, level.version
+        if state != self.state:
+            self.state = state
+            self.build_background()
+            self.full = True
+        SCREEN.blit(self.background, (0, 0))
+
+    def invalidate(self):
+        self.full = True
+
+    def present(self, rects):
+        # Если изменилась большая часть экрана, выгоднее обновить его целиком
+        dirty = self.previous + rects
+        self.previous = rects
+        area = sum(rect.w * rect.h for rect in dirty)
+        if self.full or area > FULL_FLIP_RATIO * WIDTH * HEIGHT:
+            self.full = False
+            pygame.display.flip()
+        else:
+            pygame.display.update(dirty)
+
+
+class Profiler:
+    # Замеряет время каждого этапа кадра go_game. Замеры и количество объектов хранятся в
+    # кольцевом буфере на последние PROFILER_FRAMES кадров, а сумма и максимум времени этапов
+    # копятся за весь прогон. Включается клавишей F3 вместе с графиком, F4 выгружает замеры
+    # в CSV и JSON. Бенчмарк включает только замеры, без графика
+    STAGES = ('background', 'particles', 'level', 'ai', 'enemies', 'spawn_points', 'drops',
+              'player', 'present')
+    # Счетчики ai_* - решения ближнего и дальнего ярусов EnemyAI и отложенные решения
+    COUNTERS = ('enemies', 'particles', 'drops', 'ai_near', 'ai_far', 'ai_deferred')
+    COLORS = ('gray', 'red', 'yellow', 'orange', 'green', 'cyan', 'blue', 'magenta', 'white')
+    GRAPH_HEIGHT = 100
+    GRAPH_MS = 1000 / FPS * 2  # Высота графика соответствует двум кадрам при FPS
+
+    def __init__(self, size=PROFILER_FRAMES):
+        self.enabled = False
+        self.overlay = False
+        self.times = np.zeros((size, len(self.STAGES)))
+        self.counts = np.zeros((size, len(self.COUNTERS)), dtype=np.int64)
+        self.total = np.zeros(len(self.STAGES))  # Сумма времени этапов за все кадры
+        self.peak = np.zeros(len(self.STAGES))  # Максимум времени этапов за кадр
+        self.frames = 0  # Всего записано кадров
+        self.stage = 0
+        self.start = 0
+        self.graph = None  # Создается при первом включении графика
+
+    def reset(self):
+        # Забывает записанные кадры, например кадры разогрева в бенчмарке
+        for array in (self.times, self.counts, self.total, self.peak):
+            array[:] = 0
+        self.frames = 0
+
+    def toggle(self):
+        self.enabled = self.overlay = not self.enabled
+        if self.overlay:
+            if self.graph is None:
+                self.graph = pygame.Surface((len(self.times), self.GRAPH_HEIGHT))
+            self.graph.fill('black')
+
+    def begin(self):
+        if self.enabled:
+            self.times[self.frames % len(self.times)] = 0
+            self.start = perf_counter()
+
+    def lap(self, stage):
+        # Записывает время от прошлого замера в этап stage
+        if self.enabled:
+            now = perf_counter()
+            self.times[self.frames % len(self.times), self.STAGES.index(stage)] += now - self.start
+            self.start = now
+
+    def end_frame(self):
+        if not self.enabled:
+            return
+        i = self.frames % len(self.times)
+        self.counts[i] = (len(enemies), len(particles), len(drops_group)) + AI.last
+        self.total += self.times[i]
+        np.maximum(self.peak, self.times[i], out=self.peak)
+        self.frames += 1
+        if self.overlay:
+            self.update_graph(self.times[i])
+
+    def update_graph(self, times):
+        # График сдвигается на 1 пиксель влево, справа дорисовывается столбец нового кадра
+        self.graph.scroll(-1, 0)
+        x = self.graph.get_width() - 1
+        pygame.draw.line(self.graph, 'black', (x, 0), (x, self.GRAPH_HEIGHT))
+        y = self.GRAPH_HEIGHT
+        for time, color in zip(times, self.COLORS):
+            height = time * 1000 / self.GRAPH_MS * self.GRAPH_HEIGHT
+            pygame.draw.line(self.graph, color, (x, y), (x, y - height))
+            y -= height
+        budget = self.GRAPH_HEIGHT // 2
+        self.graph.set_at((x, budget), 'white')
+
+    def draw(self):
+        # Рисует график этапов и подписи в правом верхнем углу, возвращает измененную область
+        x, y = WIDTH - self.graph.get_width() - 10, 40
+        rect = SCREEN.blit(self.graph, (x, y))
+        last = self.times[(self.frames - 1) % len(self.times)]
+        for i, (stage, color) in enumerate(zip(self.STAGES, self.COLORS)):
+            text = ASSETS.font(None, 18).render(f'{stage} {last[i] * 1000:.2f}', True, color)
+            rect.union_ip(SCREEN.blit(text, (x, y + self.GRAPH_HEIGHT + 2 + i * 14)))
+        return rect
+
+    def history(self):
+        # Замеры и счетчики в порядке записи, от старых к новым
+        count = min(self.frames, len(self.times))
+        shift = self.frames % len(self.times) if self.frames > len(self.times) else 0
+        return (np.roll(self.times, -shift, axis=0)[:count],
+                np.roll(self.counts, -shift, axis=0)[:count])
+
+    def summary(self):
+        # Среднее время этапов за все записанные кадры в миллисекундах
+        if not self.frames:
+            return {}
+        return {stage: float(value) * 1000 / self.frames
+                for stage, value in zip(self.STAGES, self.total)}
+
+    def peaks(self):
+        # Максимальное время этапов за все записанные кадры в миллисекундах
+        return {stage: float(value) * 1000 for stage, value in zip(self.STAGES, self.peak)}
+
+    def dump(self):
+        # Выгружает замеры в PROFILER_DIR в CSV и JSON, возвращает путь без расширения
+        times, counts = self.history()
+        os.makedirs(PROFILER_DIR, exist_ok=True)
+        path = os.path.join(PROFILER_DIR, f'profile_{strftime("%Y%m%d_%H%M%S")}')
+        first = self.frames - len(times)
+        with open(path + '.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(('frame',) + tuple(f'{stage}_ms' for stage in self.STAGES) +
+                            self.COUNTERS)
+            for i in range(len(times)):
+                writer.writerow([first + i] + [round(t * 1000, 4) for t in times[i]] +
+                                counts[i].tolist())
+        with open(path + '.json', 'w') as file:
+            json.dump({'stages': self.STAGES, 'counters': self.COUNTERS,
+                       'first_frame': first, 'recorded': self.frames,
+                       'mean_ms': self.summary(), 'max_ms': self.peaks(),
+                       'times_ms': (times * 1000).round(4).tolist(),
+                       'counts': counts.tolist(),
+                       'visibility': player.visibility.stats(), 'ai': AI.stats(),
+                       'pvs_bytes': level.pvs_memory(), 'rotations': ROTATIONS.stats(),
+                       'assets': ASSETS.stats()}, file)
+        return path
+
+
+PROFILER = Profiler()
+AI = EnemyAI()
 
 
 class Button(Widget):
@@ -736,8 +1699,7 @@ class Button(Widget):
     def draw(self, x, y, message):
         mouse = pygame.mouse.get_pos()
         click = pygame.mouse.get_pressed()
-        hover_sound = pygame.mixer.Sound('sounds/hover_over_the_button.mp3')
-        hover_sound.set_volume(0.1)
+        hover_sound = ASSETS.sound(*HOVER_SOUND)
 
         if x < mouse[0] < x + self.width and y < mouse[1] < y + self.height:
             pygame.draw.rect(SCREEN, (18, 19, 171), (x, y, self.width, self.height))
@@ -752,7 +1714,13 @@ class Button(Widget):
 
 
 def go_game():
+    # Игра всегда записывается с начала уровня, F5 сохраняет запись в REPLAY_DIR
+    global INPUT
+    seed = int.from_bytes(os.urandom(4), 'little')
+    random_seed(seed)
+    INPUT = PygameInput()
     init_globals()
+    INPUT = ReplayRecorder(INPUT, seed)
     exit_button = Button(100, 25, start_menu)
     pygame.mixer.music.load('sounds/background_game.mp3')
     pygame.mixer.music.set_volume(0.1)
@@ -760,6 +1728,7 @@ def go_game():
 
     pause = False
     running = True
+    accumulator = 0  # Время, которое еще не просчитано симуляцией
     while running:
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -768,62 +1737,158 @@ def go_game():
                 if event.key == pygame.K_ESCAPE:
                     pause = not pause
                     pygame.mixer.music.unpause()
+                elif event.key == pygame.K_F3:
+                    PROFILER.toggle()
+                elif event.key == pygame.K_F4:
+                    PROFILER.dump()
+                elif event.key == pygame.K_F5:
+                    INPUT.save()
+        PROFILER.begin()
         if not (pause or player.is_dead):
-            if pygame.mouse.get_pressed()[0]:
-                player.shoot()
-            all_sprites.draw(SCREEN)
-
-            bouncing_obj_group.update()
-            gun.reload -= 1
-            level.update()
-            enemies_group.update()
-            spawn_points_group.update()
-            drops_group.update()
-            player.update()
-            # walls_group.update()
-
+            accumulator = min(accumulator + CLOCK.get_time() / 1000, MAX_TICKS * TICK)
+            while accumulator >= TICK and not player.is_dead:
+                update_game()
+                accumulator -= TICK
+            draw_game(accumulator / TICK)
         else:
+            accumulator = 0
             exit_button.draw(WIDTH - 120, 10, 'В меню')
             pygame.mixer.music.pause()
-
-        interface.update(pause)
-
-        pygame.display.flip()
-        CLOCK.tick(FPS)
+            renderer.invalidate()
+
+        present_frame(pause)
+        if STARTUP['first_frame'] is None:
+            report_cold_start()
+        CLOCK.tick(RENDER_FPS)
+
+
+def update_game():
+    # Один шаг симуляции всех объектов игры, без отрисовки
+    INPUT.begin_tick()
+    if INPUT.mouse_pressed()[0]:
+        player.shoot()
+
+    particles.update()
+    PROFILER.lap('particles')
+    gun.reload -= 1
+    level.update()
+    PROFILER.lap('level')
+    AI.think(enemies)
+    PROFILER.lap('ai')
+    enemies.update()
+    PROFILER.lap('enemies')
+    spawn_points_group.update()
+    PROFILER.lap('spawn_points')
+    drops_group.update()
+    PROFILER.lap('drops')
+    player.update()
+    PROFILER.lap('player')
+    # walls_group.update()
+    INPUT.end_tick()
+
+
+def state_fingerprint():
+    # Отпечаток состояния симуляции: по нему повтор записи проверяет, что не разошелся с игрой
+    alive = enemies.indices()
+    state = (player.x, player.y, player.hp, player.max_hp, level.score, gun.dmg, gun.multishot,
+             len(alive), enemies.hp[alive].sum(), enemies.centers[alive].sum(), len(particles),
+             len(drops_group))
+    return zlib.crc32(np.array(state, dtype=np.float64).tobytes())
+
+
+def start_replay(replay):
+    # Готовит уровень к повтору записи. Размер экрана ставится как при записи: от него зависят
+    # размер клеток уровня и загруженные чанки
+    global INPUT, WIDTH, HEIGHT, SCREEN
+    if (WIDTH, HEIGHT) != (replay['width'], replay['height']):
+        WIDTH, HEIGHT = replay['width'], replay['height']
+        SCREEN = pygame.display.set_mode((WIDTH, HEIGHT))
+    clear_groups()
+    INPUT = ReplayInput(replay)
+    random_seed(replay['seed'])
+    init_globals(path=replay['map'])
+    if LEVEL != replay['level']:
+        raise ValueError(f"replay was recorded on level {replay['level']}, not {LEVEL}")
+
+
+def play_replay(path):
+    # Повтор записи в реальном времени с выводом кадров. Возвращает, совпало ли состояние
+    # в конце записи, или None, если повтор прерван клавишей Esc
+    start_replay(load_replay(path))
+    accumulator = 0
+    while not (INPUT.finished() or player.is_dead):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and
+                                             event.key == pygame.K_ESCAPE):
+                return None
+        accumulator = min(accumulator + CLOCK.get_time() / 1000, MAX_TICKS * TICK)
+        while accumulator >= TICK and not (INPUT.finished() or player.is_dead):
+            update_game()
+            accumulator -= TICK
+        draw_game(accumulator / TICK)
+        present_frame(False)
+        CLOCK.tick(RENDER_FPS)
+    return INPUT.matches()
+
+
+def draw_game(alpha=1.0):
+    # Отрисовка кадра: объекты выводятся в положении между двумя последними шагами симуляции.
+    # Камера следует за игроком в том же промежуточном положении
+    camera.follow(*player.interpolate(alpha))
+    renderer.draw_background()
+    PROFILER.lap('background')
+    particles.draw(alpha)
+    PROFILER.lap('particles')
+    enemies.draw(alpha)
+    PROFILER.lap('enemies')
+    for drop in drops_group:
+        drop.draw()
+    PROFILER.lap('drops')
+    player.draw(alpha)
+    PROFILER.lap('player')
+
+
+def present_frame(pause):
+    # Отрисовка интерфейса и вывод кадра на экран
+    rects = interface.update(pause)
+    rects.extend(player.dirty_rects)
+    if PROFILER.overlay:
+        rects.append(PROFILER.draw())
+    renderer.present(rects)
+    if not pause:
+        PROFILER.lap('present')
+        PROFILER.end_frame()
+
+
+def warm_up_kernels():
+    # Компилирует ядра numba в фоновом потоке, пока открыто меню. Ядра сохраняются на диск,
+    # поэтому при следующих запусках они только загружаются из кэша. Пул потоков numba для prange
+    # запускается в главном потоке: запущенный из фонового потока пул TBB не дает процессу
+    # завершиться
+    get_num_threads()
+    thread = Thread(target=lambda: STARTUP['kernels'].update(warm_up()), daemon=True)
+    thread.start()
+    return thread
+
+
+def report_cold_start():
+    STARTUP['first_frame'] = perf_counter() - STARTUP['start']
+    print(f"Первый кадр игры через {STARTUP['first_frame']:.2f} с после запуска, "
+          f"компиляция ядер: {sum(STARTUP['kernels'].values()):.2f} с")
 
 
 def clear_groups():
     all_sprites.empty()
     drops_group.empty()
     walls_group.empty()
-    enemies_group.empty()
-    bouncing_obj_group.empty()
     spawn_points_group.empty()
 
 
-def load_image(name, colorkey=None):
-    fullname = os.path.join('data', name)
-
-    if not os.path.isfile(fullname):
-        print(f"Файл с изображением '{fullname}' не найден")
-        sys.exit()
-    image = pygame.image.load(fullname)
-
-    if colorkey is not None:
-        image = image.convert()
-        if colorkey == -1:
-            colorkey = image.get_at((0, 0))
-        image.set_colorkey(colorkey)
-    else:
-        image = image.convert_alpha()
-    return image
-
-
 def start_menu():
     clear_groups()
-    menu_background = pygame.image.load('pictures/menu.jpg')
+    menu_background = ASSETS.image('pictures/menu.jpg')
 
-    font_game = pygame.font.Font(None, 112)
+    font_game = ASSETS.font(None, 112)
     start_button = Button(280, 70, go_game)
     quit_button = Button(280, 70, quit)
     pygame.mixer.music.load('sounds/background_menu.mp3')
@@ -847,19 +1912,35 @@ def start_menu():
         CLOCK.tick(60)
 
 
-def init_globals():
-    global LEVEL, player, level, floor, gun, enemy_rects, obstacles, ray_obstacles, interface
-    LEVEL = randint(1, 5)
-    level = Level()
+def init_globals(level_number=None, path=None):
+    # path - файл карты вместо levels/level_N.txt, например из LevelGenerator
+    global LEVEL, player, level, floor, gun, obstacles, interface, particles, renderer, camera
+    global enemies
+    LEVEL = level_number or randint(1, 5)
+    AI.reset()
+    enemies = EnemyPool()
+    level = Level(path or f'levels/level_{LEVEL}.txt')
+    obstacles = level.obstacles  # Преграды загруженных чанков
+    camera = Camera(level.width, level.height)
+    camera.follow(*level.player_location())
     interface = InterFace()
     floor = Floor()
     gun = Weapon()
+    particles = ParticlePool()
+    renderer = Renderer()
     player = Player(100, 10)
-    enemy_rects = []
-    obstacles = [wall.rect for wall in walls_group]  # Спиоск всех преград
-    ray_obstacles = List([(wall.rect.x, wall.rect.y,
-                           wall.rect.w, wall.rect.h) for wall in walls_group])
 
 
 if __name__ == '__main__':
-    start_menu()
+    parser = argparse.ArgumentParser(description='Dark Hell')
+    parser.add_argument('--replay', help='play a recorded game (F5 in game) in real time; '
+                                         'benchmark.py --replay plays it without rendering')
+    args = parser.parse_args()
+    if args.replay:
+        warm_up()
+        result = play_replay(args.replay)
+        print({True: 'replay matches', False: 'replay diverged', None: 'replay stopped'}[result])
+    else:
+        ASSETS.preload()
+        warm_up_kernels()
+        start_menu()